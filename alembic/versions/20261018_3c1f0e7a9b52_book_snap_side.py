@@ -0,0 +1,44 @@
+"""array order book storage in book_snap_side
+
+Revision ID: 3c1f0e7a9b52
+Revises: 97f48c3b0d41
+Create Date: 2026-10-18 11:02:17.554310
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = '3c1f0e7a9b52'
+down_revision = '97f48c3b0d41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('book_snap_side',
+                    sa.Column('book_snap_id', sa.BigInteger(), nullable=False),
+                    sa.Column('side', sa.String(length=1), nullable=False),
+                    sa.Column('price', postgresql.ARRAY(sa.Numeric()), nullable=False),
+                    sa.Column('amount', postgresql.ARRAY(sa.Numeric()), nullable=False),
+                    sa.ForeignKeyConstraint(['book_snap_id'], ['book_snap.book_snap_id'], ondelete='cascade'),
+                    sa.PrimaryKeyConstraint('book_snap_id', 'side'))
+    # level views over both storage modes
+    for (view, table, side) in [('vbook_snap_bid', 'book_snap_bid', 'B'), ('vbook_snap_ask', 'book_snap_ask', 'A')]:
+        op.execute(f"""
+            create view {view} as
+            select book_snap_id, price, amount
+            from {table}
+            union all
+            select s.book_snap_id, u.price, u.amount
+            from book_snap_side s,
+                unnest(s.price, s.amount) u(price, amount)
+            where s.side = '{side}'""")
+
+
+def downgrade():
+    op.execute('drop view vbook_snap_ask')
+    op.execute('drop view vbook_snap_bid')
+    op.drop_table('book_snap_side')
@@ -0,0 +1,43 @@
+"""trade5m, trade15m, trade1h, trade1d rollups
+
+Revision ID: 5e2b7c90d3f4
+Revises: b84d2a61c0e9
+Create Date: 2026-10-18 13:05:44.120937
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5e2b7c90d3f4'
+down_revision = 'b84d2a61c0e9'
+branch_labels = None
+depends_on = None
+
+ROLLUP_TABLES = ['trade5m', 'trade15m', 'trade1h', 'trade1d']
+
+
+def upgrade():
+    for table in ROLLUP_TABLES:
+        op.create_table(table,
+                        sa.Column('exchange_market_id', sa.Integer(), nullable=False),
+                        sa.Column('dt', sa.DateTime(), nullable=False),
+                        *[sa.Column(c, sa.Numeric(), nullable=True) for c in
+                          ['o', 'h', 'l', 'c', 's', 'sb', 'ss', 'z', 'zb', 'zs']],
+                        *[sa.Column(c, sa.Integer(), nullable=True) for c in ['n', 'nb', 'ns']],
+                        sa.Column('d', sa.Numeric(), nullable=True),
+                        sa.ForeignKeyConstraint(['exchange_market_id'], ['exchange_market.exchange_market_id']),
+                        sa.PrimaryKeyConstraint('exchange_market_id', 'dt'))
+    op.create_table('trade_rollup_mark',
+                    sa.Column('exchange_market_id', sa.Integer(), nullable=False),
+                    sa.Column('resolution', sa.String(length=10), nullable=False),
+                    sa.Column('dt', sa.DateTime(), nullable=False),
+                    sa.ForeignKeyConstraint(['exchange_market_id'], ['exchange_market.exchange_market_id']),
+                    sa.PrimaryKeyConstraint('exchange_market_id', 'resolution'))
+
+
+def downgrade():
+    op.drop_table('trade_rollup_mark')
+    for table in reversed(ROLLUP_TABLES):
+        op.drop_table(table)
@@ -0,0 +1,24 @@
+"""default trade partition for trades outside the monthly partitions
+
+Revision ID: 7b3d9e0f1a24
+Revises: e4a1c7b92d60
+Create Date: 2026-10-18 19:20:44.213907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7b3d9e0f1a24'
+down_revision = 'e4a1c7b92d60'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('create table if not exists trade_default partition of trade default')
+
+
+def downgrade():
+    op.execute('drop table trade_default')
@@ -0,0 +1,26 @@
+"""unique index on trade(exchange_market_id, eid)
+
+Revision ID: 97f48c3b0d41
+Revises: ee8679a36551
+Create Date: 2026-10-18 10:12:41.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '97f48c3b0d41'
+down_revision = 'ee8679a36551'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('delete from trade t using trade d '
+               'where t.exchange_market_id = d.exchange_market_id and t.eid = d.eid and t.trade_id > d.trade_id')
+    op.create_index('ix_trade_exchange_market_id_eid', 'trade', ['exchange_market_id', 'eid'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_trade_exchange_market_id_eid', table_name='trade')
@@ -0,0 +1,35 @@
+"""persistent trade fetch cursor on exchange_market
+
+Revision ID: a93e5d17c64b
+Revises: d71a4f0c8e23
+Create Date: 2026-10-18 15:02:41.318270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a93e5d17c64b'
+down_revision = 'd71a4f0c8e23'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('exchange_market', sa.Column('trade_eid', sa.String(), nullable=True))
+    op.add_column('exchange_market', sa.Column('trade_token', sa.String(), nullable=True))
+    op.execute("""
+        update exchange_market em
+        set trade_ts = t.ts, trade_eid = t.eid,
+            trade_token = case when e.symbol like 'binance%' and t.eid ~ '^[0-9]+$' then (t.eid::bigint + 1)::text end
+        from exchange e,
+             lateral (select ts, eid from trade
+                      where exchange_market_id = em.exchange_market_id
+                      order by ts desc, trade_id desc limit 1) t
+        where e.exchange_id = em.exchange_id""")
+
+
+def downgrade():
+    op.drop_column('exchange_market', 'trade_token')
+    op.drop_column('exchange_market', 'trade_eid')
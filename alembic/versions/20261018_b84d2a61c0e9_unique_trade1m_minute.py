@@ -0,0 +1,28 @@
+"""unique index on trade1m(exchange_market_id, dt)
+
+Revision ID: b84d2a61c0e9
+Revises: 3c1f0e7a9b52
+Create Date: 2026-10-18 12:20:05.907113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b84d2a61c0e9'
+down_revision = '3c1f0e7a9b52'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute('delete from trade1m t using trade1m d '
+               'where t.exchange_market_id = d.exchange_market_id and t.dt = d.dt and t.trade1m_id > d.trade1m_id')
+    op.drop_index('ix_trade1m_exchange_market_id_dt', table_name='trade1m')
+    op.create_index('ix_trade1m_exchange_market_id_dt', 'trade1m', ['exchange_market_id', 'dt'], unique=True)
+
+
+def downgrade():
+    op.drop_index('ix_trade1m_exchange_market_id_dt', table_name='trade1m')
+    op.create_index('ix_trade1m_exchange_market_id_dt', 'trade1m', ['exchange_market_id', 'dt'], unique=False)
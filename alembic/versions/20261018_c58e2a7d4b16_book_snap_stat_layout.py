@@ -0,0 +1,27 @@
+"""book_snap_stat.layout tells the bookSnapStat and numpy data layouts apart
+
+Revision ID: c58e2a7d4b16
+Revises: 7b3d9e0f1a24
+Create Date: 2026-10-18 19:41:03.128455
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c58e2a7d4b16'
+down_revision = '7b3d9e0f1a24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # rows written before carry no marker, numpy rows are told apart by their {mid, bid: {n, amount, total}} shape
+    op.add_column('book_snap_stat', sa.Column('layout', sa.String(length=10), nullable=False, server_default='sql'))
+    op.execute("update book_snap_stat set layout = 'numpy' "
+               "where data ? 'mid' and jsonb_typeof(data -> 'bid') = 'object' and data -> 'bid' ? 'total'")
+
+
+def downgrade():
+    op.drop_column('book_snap_stat', 'layout')
@@ -0,0 +1,91 @@
+"""range partition trade by ts, one partition per month
+
+Revision ID: d71a4f0c8e23
+Revises: 5e2b7c90d3f4
+Create Date: 2026-10-18 14:31:09.664021
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd71a4f0c8e23'
+down_revision = '5e2b7c90d3f4'
+branch_labels = None
+depends_on = None
+
+TRADE_INDEXES = """
+    create index ix_trade_ts_exchange_market_id on trade(ts, exchange_market_id);
+    create index ix_trade_exchange_market_id_ts on trade(exchange_market_id, ts);
+    create index ix_trade_exchange_market_id_trade_id on trade(exchange_market_id, trade_id);
+    create index ix_trade_exchange_market_id_dts on trade(exchange_market_id, to_timestamp(ts::numeric / 1000::numeric));
+"""
+
+
+def upgrade():
+    op.execute('alter table trade rename to trade_old')
+    op.execute('alter table trade_old rename constraint trade_pkey to trade_old_pkey')
+    for ix in ['ix_trade_ts_exchange_market_id', 'ix_trade_exchange_market_id_ts', 'ix_trade_exchange_market_id_dts',
+               'ix_trade_exchange_market_id_eid', 'ix_trade_exchange_market_id_trade_id']:
+        op.execute('drop index if exists {}'.format(ix))
+    op.execute("""
+        create table trade (
+            trade_id bigint not null default nextval('trade_trade_id_seq'),
+            exchange_market_id integer not null references exchange_market(exchange_market_id),
+            ts bigint not null,
+            side varchar(1) not null,
+            price numeric not null,
+            amount numeric not null,
+            fee numeric,
+            eid varchar(32),
+            primary key (trade_id, ts)
+        ) partition by range (ts)""")
+    op.execute('alter sequence trade_trade_id_seq owned by trade.trade_id')
+    op.execute(TRADE_INDEXES)
+    op.execute('create unique index ix_trade_exchange_market_id_eid on trade(exchange_market_id, eid, ts)')
+    # monthly partitions from the oldest trade up to three months ahead, bounds in epoch ms (UTC)
+    op.execute("""
+        do $$
+            declare
+                m timestamp;
+            begin
+                for m in select generate_series(
+                                    date_trunc('month', coalesce((select to_timestamp(min(ts) / 1000.0) at time zone 'UTC'
+                                                                  from trade_old),
+                                                                 now() at time zone 'UTC')),
+                                    date_trunc('month', now() at time zone 'UTC') + interval '3 month',
+                                    interval '1 month')
+                    loop
+                        execute format('create table %I partition of trade for values from (%s) to (%s)',
+                                       'trade_p' || to_char(m, 'YYYYMM'),
+                                       (extract(epoch from m) * 1000)::bigint,
+                                       (extract(epoch from m + interval '1 month') * 1000)::bigint);
+                    end loop;
+            end
+        $$""")
+    op.execute('insert into trade select trade_id, exchange_market_id, ts, side, price, amount, fee, eid from trade_old')
+    op.execute('drop table trade_old')
+
+
+def downgrade():
+    op.execute('alter table trade rename to trade_part')
+    op.execute('alter table trade_part rename constraint trade_pkey to trade_part_pkey')
+    op.execute('drop index if exists ix_trade_ts_exchange_market_id, ix_trade_exchange_market_id_ts, '
+               'ix_trade_exchange_market_id_dts, ix_trade_exchange_market_id_eid, ix_trade_exchange_market_id_trade_id')
+    op.execute("""
+        create table trade (
+            trade_id bigint not null default nextval('trade_trade_id_seq') primary key,
+            exchange_market_id integer not null references exchange_market(exchange_market_id),
+            ts bigint not null,
+            side varchar(1) not null,
+            price numeric not null,
+            amount numeric not null,
+            fee numeric,
+            eid varchar(32)
+        )""")
+    op.execute('alter sequence trade_trade_id_seq owned by trade.trade_id')
+    op.execute(TRADE_INDEXES)
+    op.execute('create unique index ix_trade_exchange_market_id_eid on trade(exchange_market_id, eid)')
+    op.execute('insert into trade select trade_id, exchange_market_id, ts, side, price, amount, fee, eid from trade_part')
+    op.execute('drop table trade_part')
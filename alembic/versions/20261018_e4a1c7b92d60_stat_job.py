@@ -0,0 +1,36 @@
+"""stat_job leased per market stat work
+
+Revision ID: e4a1c7b92d60
+Revises: f2c8b6a4d915
+Create Date: 2026-10-18 18:12:07.904318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a1c7b92d60'
+down_revision = 'f2c8b6a4d915'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('stat_job',
+                    sa.Column('exchange_market_id', sa.Integer(), nullable=False),
+                    sa.Column('mark', sa.BigInteger(), nullable=True),
+                    sa.Column('lease_until', sa.DateTime(), nullable=True),
+                    sa.Column('owner', sa.String(length=100), nullable=True),
+                    sa.Column('attempts', sa.Integer(), nullable=False, server_default='0'),
+                    sa.Column('error', sa.String(length=1000), nullable=True),
+                    sa.ForeignKeyConstraint(['exchange_market_id'], ['exchange_market.exchange_market_id']),
+                    sa.PrimaryKeyConstraint('exchange_market_id'))
+    op.execute('insert into stat_job(exchange_market_id) '
+               'select exchange_market_id from exchange_market where trade_ts is not null')
+    op.create_index('ix_book_snap_2', 'book_snap', ['exchange_market_id'], postgresql_where=sa.text('not stat'))
+
+
+def downgrade():
+    op.drop_index('ix_book_snap_2', table_name='book_snap')
+    op.drop_table('stat_job')
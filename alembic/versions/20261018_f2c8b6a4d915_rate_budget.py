@@ -0,0 +1,27 @@
+"""rate_budget shared request budget per exchange
+
+Revision ID: f2c8b6a4d915
+Revises: a93e5d17c64b
+Create Date: 2026-10-18 16:40:12.552904
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c8b6a4d915'
+down_revision = 'a93e5d17c64b'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('rate_budget',
+                    sa.Column('exchange', sa.String(length=50), nullable=False),
+                    sa.Column('tat', sa.Float(), nullable=False),
+                    sa.PrimaryKeyConstraint('exchange'))
+
+
+def downgrade():
+    op.drop_table('rate_budget')
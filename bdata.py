@@ -1,36 +1,33 @@
+import asyncio
 import datetime
 import json
 import logging
-import sys
+import threading
 import time
 from argparse import ArgumentParser, Namespace
-from copy import deepcopy
-from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from typing import Tuple, Optional
+from functools import partial
+from typing import Optional
 
 import ccxt
-from sqlalchemy import and_, func
 
+from bdata_cache import market_cache
 from bdata_db import Session
-from bdata_model import Token, ExchangeMarket, Exchange, BookSnap, BookSnapBid, BookSnapAsk, Trade
-
-KUCOIN = 'kucoin'
-BINANCE = 'binance'
-COINBASEPRO = 'coinbasepro'
+from bdata_metrics import metrics, METRICS_HOST
+from bdata_retry import RetryPolicy
+from bdata_sched import MarketScheduler
+from bdata_snap import SnapTarget, BookStorage, RateScope, snap, stream_snap, make_poll, init_exchange, \
+    refresh_markets, log_stats, markets_ts, MARKETS_CACHE_TTL, STATS_LOG_INTERVAL
 
 args: Optional[Namespace] = None
 base_list: list = []
 quote_list: list = []
 
-DEFAULT_BOOK_LIMIT = None
-TRADES_LIMIT = 100000
-
 
-class SnapTarget(Enum):
-    ALL = "all"
-    BOOK = "book"
-    TRADE = "trade"
+class Engine(Enum):
+    THREAD = "thread"
+    ASYNC = "async"
 
 
 TOP_EXCHANGES = ['hitbtc', 'bitfinex', 'binance', 'huobipro', 'kraken', 'zb', 'coinbasepro', 'okex', 'bittrex',
@@ -65,219 +62,6 @@ DISABLED_EXCHANGES = ['bitfinex2', 'anxpro', 'bcex', 'vaultoro', 'coss', 'coolco
                       ]
 
 
-def decimalize(book):
-    return {'bids': [(Decimal(str(b[0])), Decimal(str(b[1]))) for b in book['bids']],
-            'asks': [(Decimal(str(a[0])), Decimal(str(a[1]))) for a in book['asks']]
-            }
-
-
-def book_limit(exchange: ccxt.Exchange):
-    if exchange.id == KUCOIN:
-        return 100
-    elif exchange.id == BINANCE:
-        return 5000
-    else:
-        return DEFAULT_BOOK_LIMIT
-
-
-def book_params(exchange: ccxt.Exchange):
-    if exchange.id == COINBASEPRO:
-        return {'level': 3}
-    else:
-        return {}
-
-
-def ensure_exchange_market(session, exchange, base, quote) -> Tuple[Exchange, ExchangeMarket, Token, Token]:
-    e = session.query(Exchange).filter(Exchange.symbol == exchange.id).first()
-    if not e:
-        e = Exchange(symbol=exchange.id)
-        session.add(e)
-        session.commit()
-
-    tokens = session.query(Token).all()
-    bt = next((t for t in tokens if t.symbol == base), None)
-    if not bt:
-        bt = Token(symbol=base)
-        session.add(bt)
-        session.commit()
-
-    qt = next((t for t in tokens if t.symbol == quote), None)
-    if not qt:
-        qt = Token(symbol=quote)
-        session.add(qt)
-        session.commit()
-
-    em = session.query(ExchangeMarket).filter(
-        and_(ExchangeMarket.exchange_id == e.exchange_id, ExchangeMarket.base_token_id == bt.token_id,
-             ExchangeMarket.quote_token_id == qt.token_id, )).first()
-    if not em:
-        em = ExchangeMarket(exchange_id=e.exchange_id, base_token_id=bt.token_id,
-                            quote_token_id=qt.token_id)
-        session.add(em)
-        session.commit()
-
-    return e, em, bt, qt
-
-
-def snap_book(session, mts: datetime.datetime, exchange: ccxt.Exchange, base: str, quote: str):
-    logging.info('{}::{} snap book'.format(exchange.id, base + '/' + quote))
-    (e, em, bt, qt) = ensure_exchange_market(session, exchange, base, quote)
-
-    bs = session.query(BookSnap).filter(
-        and_(BookSnap.exchange_market_id == em.exchange_market_id, BookSnap.mts == mts)).first()
-    if bs:
-        return
-
-    bs = BookSnap(exchange_market_id=em.exchange_market_id, mts=mts)
-    session.add(bs)
-    bo = exchange.fetch_order_book(bt.symbol + '/' + qt.symbol, limit=book_limit(exchange),
-                                   params=book_params(exchange))
-    b = decimalize(bo)
-    for (p, a) in b['bids']:
-        bs.bids.append(BookSnapBid(price=p, amount=a))
-    for (p, a) in b['asks']:
-        bs.asks.append(BookSnapAsk(price=p, amount=a))
-    session.commit()
-
-    bs.stat = False
-    session.add(bs)
-    session.commit()
-
-
-def snap_trades(session, ts: datetime.datetime, exchange: ccxt.Exchange, base: str, quote: str):
-    logging.info('{}::{} snap trades'.format(exchange.id, base + '/' + quote))
-    try:
-        (e, em, bt, qt) = ensure_exchange_market(session, exchange, base, quote)
-
-        max_trade_id = session.query(func.max(Trade.trade_id)). \
-            filter(Trade.exchange_market_id == em.exchange_market_id).first()
-        max_trade_id = max_trade_id and max_trade_id[0]
-
-        if max_trade_id:
-            last = session.query(Trade).filter(Trade.trade_id == max_trade_id).one()
-        else:
-            last = None
-
-        if last and last.eid:
-            last_eid = last.eid
-        else:
-            last_eid = ''
-
-        if em.trade_ts:
-            since = em.trade_ts
-        else:
-            if max_trade_id:
-                since = session.query(Trade).filter(Trade.trade_id == max_trade_id).one().ts
-            else:
-                since = exchange.milliseconds() - exchange.milliseconds() % 86400000
-
-        trades_all = []
-        market = base + '/' + quote
-        max_ts = exchange.milliseconds()
-        trades_prior = None
-        if exchange.id.startswith(BINANCE):
-            while since < max_ts and len(trades_all) < TRADES_LIMIT:
-                trades_tmp = exchange.fetch_trades(symbol=market, since=since)
-                if json.dumps(trades_prior, sort_keys=True) == json.dumps(trades_tmp, sort_keys=True):
-                    since += 55 * 60 * 1000
-                else:
-                    if len(trades_tmp) > 0:
-                        trades_all += trades_tmp
-                        since = trades_tmp[-1]['timestamp']
-                    else:
-                        since += 55 * 60 * 1000
-                trades_prior = deepcopy(trades_tmp)
-        else:
-            while since < max_ts and len(trades_all) < TRADES_LIMIT:
-                trades_tmp = exchange.fetch_trades(market, since)
-                if len(trades_tmp) > 0:
-                    if last_eid == trades_tmp[-1]['id']:
-                        break
-                    since = trades_tmp[-1]['timestamp']
-                    last_eid = trades_tmp[-1]['id']
-                    trades_all += trades_tmp
-                else:
-                    break
-
-        # duplicates
-        found = True
-        while found:
-            found = False
-            for i in range(1, len(trades_all)):
-                if trades_all[i - 1]['id'] == trades_all[i]['id']:
-                    del trades_all[i - 1]
-                    found = True
-                    break
-        if last and last.eid:
-            i2 = 0
-            while (i2 < len(trades_all)) and (trades_all[i2]['id'] != last.eid):
-                i2 += 1
-            if i2 < len(trades_all):
-                trades_all = trades_all[i2 + 1:]
-
-        logging.info('{}::{} len={}'.format(exchange.id, market, len(trades_all)))
-        if len(trades_all) > 0:
-            for e in trades_all:
-                session.add(
-                    Trade(exchange_market_id=em.exchange_market_id,
-                          ts=e['timestamp'],
-                          side='B' if e['side'] == 'buy' else 'S',
-                          price=Decimal(str(e['price'])) if e['price'] else 0,
-                          amount=Decimal(str(e['amount'])) if e['amount'] else 0,
-                          eid=e['id']))
-            em.trade_ts = trades_all[-1]['timestamp']
-            session.add(em)
-
-        session.commit()
-
-        logging.info('{}::{} end'.format(exchange.id, market))
-    except:
-        session.rollback()
-        raise
-
-
-RETRIES = 3
-
-
-def snap(exchange: ccxt.Exchange, market: dict, ts: datetime, snap_target: SnapTarget):
-    session = Session()
-    try:
-        base = market['base']
-        quote = market['quote']
-        (e, em, bt, qt) = ensure_exchange_market(session, exchange, base, quote)
-        if em.disabled:
-            return
-        if snap_target in [SnapTarget.ALL, SnapTarget.BOOK]:
-            c = 0
-            while c < RETRIES:
-                try:
-                    snap_book(session, ts, exchange, base, quote)
-                    break
-                except:
-                    logging.error(
-                        '{}::{} {} {}'.format(exchange.id, market['symbol'], sys.exc_info()[0].__name__,
-                                              sys.exc_info()[1]))
-                    c = c + 1
-                    if c < RETRIES:
-                        time.sleep(5)
-
-        if snap_target in [SnapTarget.ALL, SnapTarget.TRADE]:
-            c = 0
-            while c < RETRIES:
-                try:
-                    snap_trades(session, ts, exchange, base, quote)
-                    break
-                except:
-                    logging.error(
-                        '{}::{} {} {}'.format(exchange.id, market['symbol'], sys.exc_info()[0].__name__,
-                                              sys.exc_info()[1]))
-                    c = c + 1
-                    if c < RETRIES:
-                        time.sleep(5)
-    finally:
-        session.close()
-
-
 def market_filter(market) -> bool:
     global base_list, quote_list
     if 'active' in market and not market['active']:
@@ -288,10 +72,6 @@ def market_filter(market) -> bool:
                (market['quote'] in quote_list or quote_list[0] == '*') and '/' in market['symbol']
 
 
-def exchange_filter(exchange) -> bool:
-    return exchange.has['publicAPI'] and exchange.has['fetchOrderBook'] and exchange.has['fetchTrades']
-
-
 def last_ts():
     now = datetime.datetime.now()
     ts = datetime.datetime(now.year, now.month, now.day)
@@ -300,13 +80,6 @@ def last_ts():
     return ts + datetime.timedelta(seconds=s)
 
 
-def create_exchange(cls):
-    exchange = cls()
-    if exchange.id.startswith('bitfinex'):
-        exchange.rateLimit = 5000
-    return exchange
-
-
 def bdata():
     cfg = json.loads(open('config.json').read())
 
@@ -314,12 +87,28 @@ def bdata():
     parser.add_argument('--exchange', required=True)
     parser.add_argument('--interval', default=300, type=int)
     parser.add_argument('--snap_target', type=SnapTarget, choices=list(SnapTarget), default=SnapTarget.TRADE)
+    parser.add_argument('--book_storage', type=BookStorage, choices=list(BookStorage), default=BookStorage.ROWS)
     parser.add_argument('--base', required=True)
     parser.add_argument('--quote', required=True)
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--workers', default=16, type=int)
+    parser.add_argument('--exchange_workers', default=4, type=int)
+    parser.add_argument('--engine', type=Engine, choices=list(Engine), default=Engine.THREAD)
+    parser.add_argument('--rate_scope', type=RateScope, choices=list(RateScope), default=RateScope.LOCAL)
+    # adaptive trade polling bounds in seconds, min defaults to --interval; max is the staleness accepted for quiet
+    # markets, 0 (default) polls trades every --interval
+    parser.add_argument('--min_poll', type=int)
+    parser.add_argument('--max_poll', default=0, type=int)
+    # stream mode: recorded events to replay instead of live feeds, file to record to
+    parser.add_argument('--stream_replay')
+    parser.add_argument('--stream_record')
+    # port and address serving /metrics in the Prometheus text format, port 0 disables it
+    parser.add_argument('--metrics_port', default=0, type=int)
+    parser.add_argument('--metrics_host', default=METRICS_HOST)
     global args
     args = parser.parse_args()
+    if args.engine == Engine.ASYNC and args.snap_target == SnapTarget.STREAM:
+        parser.error('--snap_target=stream runs on the thread engine, --engine=async is not supported with it')
     if args.exchange == '*':
         exchange_list = ccxt.exchanges
         for e in DISABLED_EXCHANGES:
@@ -333,49 +122,54 @@ def bdata():
     base_list = args.base.split(',')
     quote_list = args.quote.split(',')
 
-    markets = []
-    exchanges = []
-    for name in exchange_list:
-        exchange = create_exchange(getattr(ccxt, name))
-        if exchange_filter(exchange):
-            try:
-                if 'proxies' in cfg:
-                    exchange.proxies = cfg['proxies']
-                    exchange.enableRateLimit = False
-                else:
-                    exchange.enableRateLimit = True
-                m = exchange.load_markets()
-                exchanges.append(exchange)
-                exchange.timeout = 60000
-                markets.append(m)
-            except Exception as e:
-                logging.error('{} error {}'.format(exchange.id, str(e)))
-                pass
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+
+    session = Session()
+    try:
+        market_cache.load(session)
+    finally:
+        session.close()
+
+    if args.engine == Engine.ASYNC:
+        from bdata_async import AsyncEngine
+        asyncio.run(AsyncEngine(args).run(exchange_list, cfg, market_filter, last_ts))
+        return
+
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        shared = args.rate_scope == RateScope.SHARED
+        exchanges = [e for e in pool.map(partial(init_exchange, cfg=cfg, shared=shared), exchange_list) if e]
 
     if len(exchanges) == 0:
         logging.error('exchanges list is empty')
     else:
+        retry = RetryPolicy()
+        poll = make_poll(args)
+        fn = partial(snap, snap_target=args.snap_target, book_storage=args.book_storage, poll=poll, retry=retry)
+        if args.snap_target == SnapTarget.STREAM:
+            from bdata_stream import StreamCollector
+            collector = StreamCollector(args, exchanges, market_filter)
+            collector.start()
+            fn = partial(stream_snap, collector=collector, book_storage=args.book_storage, poll=poll, retry=retry)
+        scheduler = MarketScheduler(args.workers, args.exchange_workers, fn, retry)
         ts = last_ts()
+        stats_log_ts = time.time()
         while True:
             if datetime.datetime.now() > ts:
                 current_ts = ts
-                logging.info('start snap ts={}'.format(current_ts))
-                # with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
-                #     tasks = []
-                #     for i in range(0, len(exchanges)):
-                #         for m in markets[i].keys():
-                #             if market_filter(markets[i][m]):
-                #                 tasks.append(
-                #                     pool.submit(snap, deepcopy(exchanges[i]), deepcopy(markets[i][m]), current_ts,
-                #                                 args.snap_target))
-                #     ts = last_ts() + datetime.timedelta(seconds=args.interval)
-                #     concurrent.futures.wait(tasks, return_when=concurrent.futures.ALL_COMPLETED)
-                for i in range(0, len(exchanges)):
-                    for m in markets[i].keys():
-                        if market_filter(markets[i][m]):
-                            snap(exchanges[i], markets[i][m], current_ts, args.snap_target)
                 ts = last_ts() + datetime.timedelta(seconds=args.interval)
-                logging.info('end snap ts={}'.format(current_ts))
+                logging.info('start snap ts={}'.format(current_ts))
+                metrics.set('cycle_start_lag_seconds', (datetime.datetime.now() - current_ts).total_seconds())
+                if time.time() - stats_log_ts > STATS_LOG_INTERVAL:
+                    stats_log_ts = time.time()
+                    log_stats(exchanges)
+                for exchange in exchanges:
+                    if time.time() - markets_ts.get(exchange.id, 0) > MARKETS_CACHE_TTL:
+                        markets_ts[exchange.id] = time.time()
+                        threading.Thread(target=refresh_markets, args=(exchange,), daemon=True).start()
+                jobs = [(exchange, [m for m in list(exchange.markets.values()) if market_filter(m)])
+                        for exchange in exchanges]
+                scheduler.schedule(jobs, current_ts, ts)
             else:
                 time.sleep(0.1)
 
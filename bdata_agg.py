@@ -1,12 +1,18 @@
 import logging
 from datetime import datetime
+from typing import Iterator, Optional
 
 import numpy as np
 import pandas as pd
-from sqlalchemy import func
+from sqlalchemy import func, select, cast, Float
+from sqlalchemy.orm import aliased
 
+from bdata_archive import archived_batches
 from bdata_db import *
-from bdata_model import ExchangeMarket, Trade
+from bdata_model import ExchangeMarket, Trade, Exchange, Token
+
+CHUNK_SIZE = 100000
+SUM_COLUMNS = ['s', 'sb', 'ss', 'z', 'zb', 'zs', 'n', 'nb', 'ns']
 
 
 def agg_ohlcv(x):
@@ -21,16 +27,117 @@ def agg_ohlcv(x):
     return pd.Series(names)
 
 
-def mydf():
-    return pd.read_sql_query(
-        "select dts, side, price, amount, total from vemt where e_symbol='binance' and bt='EDO' and qt='BTC'",
-        con=engine)
+def exchange_market_id(exchange: str, base: str, quote: str) -> Optional[int]:
+    bt = aliased(Token)
+    qt = aliased(Token)
+    session = Session()
+    try:
+        row = session.query(ExchangeMarket.exchange_market_id). \
+            join(Exchange, Exchange.exchange_id == ExchangeMarket.exchange_id). \
+            join(bt, bt.token_id == ExchangeMarket.base_token_id). \
+            join(qt, qt.token_id == ExchangeMarket.quote_token_id). \
+            filter(Exchange.symbol == exchange, bt.symbol == base, qt.symbol == quote).first()
+        return row and row[0]
+    finally:
+        session.close()
 
 
-def ohlcv(df: pd.DataFrame, slice):
+def trade_frame(rows: list) -> pd.DataFrame:
+    df = pd.DataFrame(rows, columns=['ts', 'side', 'price', 'amount'])
+    df.index = pd.DatetimeIndex(pd.to_datetime(df.pop('ts'), unit='ms'), name='dts')
+    df['total'] = df['price'] * df['amount']
+    return df
+
+
+def trade_chunks(exchange: str, base: str, quote: str, start: Optional[datetime] = None,
+                 end: Optional[datetime] = None, chunk_size: int = CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    """Streams trades of one market in [start, end), archived months first then live rows through a server side
+    cursor, chunk_size rows per frame."""
+    emid = exchange_market_id(exchange, base, quote)
+    if emid is None:
+        return
+    start_ms = int(start.timestamp() * 1000) if start else None
+    end_ms = int(end.timestamp() * 1000) if end else None
+    for batch in archived_batches(emid, start_ms, end_ms, chunk_size):
+        yield trade_frame(batch.to_pandas())
+    q = select(Trade.ts, Trade.side, cast(Trade.price, Float), cast(Trade.amount, Float)). \
+        where(Trade.exchange_market_id == emid). \
+        order_by(Trade.ts, Trade.trade_id)
+    if start_ms is not None:
+        q = q.where(Trade.ts >= start_ms)
+    if end_ms is not None:
+        q = q.where(Trade.ts < end_ms)
+    with engine.connect() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(q)
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            yield trade_frame(rows)
+
+
+def mydf(exchange: str = 'binance', base: str = 'EDO', quote: str = 'BTC', start: Optional[datetime] = None,
+         end: Optional[datetime] = None) -> pd.DataFrame:
+    chunks = list(trade_chunks(exchange, base, quote, start, end))
+    return pd.concat(chunks) if chunks else trade_frame([])
+
+
+def ohlcv_apply(df: pd.DataFrame, slice):
     return df.resample(slice).apply(agg_ohlcv)
 
 
+def ohlcv_split(df: pd.DataFrame, slice) -> pd.DataFrame:
+    """Vectorized OHLCV of a trade frame indexed by time, with the trade1m buy/sell split columns."""
+    price = df['price'].astype(np.float64)
+    amount = df['amount'].astype(np.float64)
+    total = price * amount
+    buy = df['side'] == 'B'
+    frame = pd.DataFrame({'s': amount, 'sb': amount.where(buy, 0.0), 'ss': amount.where(~buy, 0.0),
+                          'z': total, 'zb': total.where(buy, 0.0), 'zs': total.where(~buy, 0.0),
+                          'n': 1, 'nb': buy.astype(np.int64), 'ns': (~buy).astype(np.int64)}, index=df.index)
+    out = price.resample(slice).ohlc()
+    out = out.join(frame.resample(slice).sum())
+    out['volume'] = out['s']
+    out['d'] = out['sb'] - out['ss']
+    return out
+
+
+def merge_bar(a: pd.Series, b: pd.Series) -> pd.Series:
+    m = a.copy()
+    m[SUM_COLUMNS] = a[SUM_COLUMNS] + b[SUM_COLUMNS]
+    m['open'] = a['open'] if pd.notna(a['open']) else b['open']
+    m['close'] = b['close'] if pd.notna(b['close']) else a['close']
+    m['high'] = np.fmax(a['high'], b['high'])
+    m['low'] = np.fmin(a['low'], b['low'])
+    m['volume'] = m['s']
+    m['d'] = m['sb'] - m['ss']
+    return m
+
+
+def ohlcv_stream(chunks: Iterator[pd.DataFrame], slice) -> pd.DataFrame:
+    """ohlcv_split over time ordered chunks, bars cut by a chunk boundary are merged."""
+    parts = []
+    for chunk in chunks:
+        bars = ohlcv_split(chunk, slice)
+        if len(bars) == 0:
+            continue
+        if parts and parts[-1].index[-1] == bars.index[0]:
+            last = parts[-1]
+            bars.iloc[0] = merge_bar(last.iloc[-1], bars.iloc[0])
+            parts[-1] = last.iloc[:-1]
+        parts.append(bars)
+    if not parts:
+        return ohlcv_split(trade_frame([]), slice)
+    out = pd.concat(parts)
+    out = out.reindex(pd.date_range(out.index[0], out.index[-1], freq=slice))
+    out[SUM_COLUMNS + ['volume', 'd']] = out[SUM_COLUMNS + ['volume', 'd']].fillna(0)
+    return out
+
+
+def ohlcv(df: pd.DataFrame, slice):
+    return ohlcv_split(df, slice)[['low', 'high', 'open', 'close', 'volume']]
+
+
 def agg():
     session = Session()
     for em in session.query(ExchangeMarket).all():
@@ -0,0 +1,136 @@
+import logging
+import os
+from argparse import ArgumentParser
+from datetime import datetime
+from typing import Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from sqlalchemy import text
+
+from bdata_db import cfg, engine
+from bdata_partition import add_months, month_ms
+
+ARCHIVE_DIR = cfg.get('archive_dir', 'archive')
+CHUNK_SIZE = 100000
+
+# price, amount and fee are kept as numeric text so the archive is exact
+ARCHIVE_SCHEMA = pa.schema([('trade_id', pa.int64()), ('ts', pa.int64()), ('side', pa.string()),
+                            ('price', pa.string()), ('amount', pa.string()), ('fee', pa.string()),
+                            ('eid', pa.string())])
+
+
+def archive_path(exchange_market_id: int, year: int, month: int) -> str:
+    return os.path.join(ARCHIVE_DIR, str(exchange_market_id), '{:04d}{:02d}.parquet'.format(year, month))
+
+
+def archive_month(exchange_market_id: int, year: int, month: int) -> int:
+    """Exports one month of a market to parquet and deletes it from trade, returns rows archived."""
+    (ny, nm) = add_months(year, month, 1)
+    params = {'emid': exchange_market_id, 'lo': month_ms(year, month), 'hi': month_ms(ny, nm)}
+    path = archive_path(exchange_market_id, year, month)
+    if os.path.exists(path):
+        return finish_month(path, params)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + '.tmp'
+    n = 0
+    with engine.begin() as connection:
+        result = connection.execution_options(stream_results=True, max_row_buffer=CHUNK_SIZE).execute(text(
+            'select trade_id, ts, side, price::text, amount::text, fee::text, eid from trade '
+            'where exchange_market_id = :emid and ts >= :lo and ts < :hi order by ts, trade_id'), params)
+        with pq.ParquetWriter(tmp, ARCHIVE_SCHEMA, compression='zstd') as writer:
+            while True:
+                rows = result.fetchmany(CHUNK_SIZE)
+                if not rows:
+                    break
+                writer.write_table(pa.Table.from_arrays([pa.array(c, type=f.type) for (c, f) in
+                                                         zip(zip(*rows), ARCHIVE_SCHEMA)], schema=ARCHIVE_SCHEMA))
+                n += len(rows)
+        if n == 0:
+            os.remove(tmp)
+            return 0
+        os.replace(tmp, path)
+        try:
+            connection.execute(text('delete from trade where exchange_market_id = :emid and ts >= :lo and ts < :hi'),
+                               params)
+        except:
+            os.remove(path)
+            raise
+    logging.info('archived {} rows={}'.format(path, n))
+    return n
+
+
+def finish_month(path: str, params: dict) -> int:
+    """Deletes the rows of an already written month left in trade by a run that stopped before its delete, when
+    they match the file row for row in number; returns rows deleted."""
+    n = pq.ParquetFile(path).metadata.num_rows
+    with engine.begin() as connection:
+        left = connection.execute(text('select count(*) from trade '
+                                       'where exchange_market_id = :emid and ts >= :lo and ts < :hi'), params).scalar()
+        if left == 0:
+            return 0
+        if left != n:
+            logging.error('{} rows={} but trade holds {} rows of the month, left as is'.format(path, n, left))
+            return 0
+        connection.execute(text('delete from trade where exchange_market_id = :emid and ts >= :lo and ts < :hi'),
+                           params)
+    logging.info('archived {} rows={}, finished delete'.format(path, n))
+    return n
+
+
+def archive(keep: int, exchange_market_id: Optional[int] = None):
+    """Archives every month that ended more than keep months ago and is already aggregated in trade1m."""
+    now = datetime.utcnow()
+    (cy, cm) = add_months(now.year, now.month, -keep)
+    with engine.connect() as connection:
+        markets = connection.execute(text("""
+            select em.exchange_market_id,
+                   (select min(ts) from trade where exchange_market_id = em.exchange_market_id) min_ts,
+                   (select max(dt) from trade1m where exchange_market_id = em.exchange_market_id) max_dt
+            from exchange_market em
+            where :emid is null or em.exchange_market_id = :emid"""), {'emid': exchange_market_id}).fetchall()
+    for (emid, min_ts, max_dt) in markets:
+        if min_ts is None or max_dt is None:
+            continue
+        first = datetime.utcfromtimestamp(min_ts / 1000)
+        (y, m) = (first.year, first.month)
+        while (y, m) < (cy, cm) and add_months(y, m, 1) <= (max_dt.year, max_dt.month):
+            archive_month(emid, y, m)
+            (y, m) = add_months(y, m, 1)
+
+
+def archived_batches(exchange_market_id: int, start_ms: Optional[int] = None, end_ms: Optional[int] = None,
+                     chunk_size: int = CHUNK_SIZE) -> Iterator[pa.RecordBatch]:
+    """Streams archived months of a market in time order, chunk_size rows at a time, yields (ts, side, price,
+    amount) float batches."""
+    d = os.path.join(ARCHIVE_DIR, str(exchange_market_id))
+    if not os.path.isdir(d):
+        return
+    for name in sorted(f for f in os.listdir(d) if f.endswith('.parquet')):
+        (y, m) = (int(name[0:4]), int(name[4:6]))
+        if (end_ms is not None and month_ms(y, m) >= end_ms) or \
+                (start_ms is not None and month_ms(*add_months(y, m, 1)) <= start_ms):
+            continue
+        f = pq.ParquetFile(os.path.join(d, name), memory_map=True)
+        for batch in f.iter_batches(batch_size=chunk_size, columns=['ts', 'side', 'price', 'amount']):
+            if start_ms is not None:
+                batch = batch.filter(pc.greater_equal(batch.column(0), start_ms))
+            if end_ms is not None:
+                batch = batch.filter(pc.less(batch.column(0), end_ms))
+            if batch.num_rows:
+                yield pa.RecordBatch.from_arrays([batch.column(0), batch.column(1),
+                                                  pc.cast(batch.column(2), pa.float64()),
+                                                  pc.cast(batch.column(3), pa.float64())],
+                                                 names=['ts', 'side', 'price', 'amount'])
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    parser = ArgumentParser()
+    # months kept in the database
+    parser.add_argument('--keep', default=3, type=int)
+    parser.add_argument('--exchange_market_id', type=int)
+    args = parser.parse_args()
+    archive(args.keep, args.exchange_market_id)
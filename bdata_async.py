@@ -0,0 +1,219 @@
+import asyncio
+import contextvars
+import datetime
+import logging
+import time
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Callable, Optional
+
+import ccxt.async_support
+
+from bdata_db import Session
+from bdata_metrics import metrics
+from bdata_page import page_strategy
+from bdata_retry import RetryPolicy, classify
+from bdata_sched import RateGate, SharedRateGate, rate_gate
+from bdata_snap import SnapTarget, book_limit, book_params, book_exists, store_book, trade_cursor, \
+    page_trades, store_trades, snap_failed, snap_parts, snap_error, part_key, ensure_exchange_market, \
+    exchange_filter, create_exchange, use_markets_cache, write_markets_cache, markets_ts, MARKETS_CACHE_TTL, \
+    make_poll, RateScope, log_stats, STATS_LOG_INTERVAL
+
+
+class AsyncRateGate:
+    """asyncio front of a bdata_sched gate, shared gates reserve their slot off the event loop."""
+
+    def __init__(self, gate: RateGate):
+        self.gate = gate
+        self.stats = gate.stats
+
+    def penalize(self, seconds: float):
+        self.gate.penalize(seconds)
+
+    async def __call__(self, *args):
+        if isinstance(self.gate, SharedRateGate):
+            wait = await asyncio.get_running_loop().run_in_executor(None, self.gate.reserve)
+        else:
+            wait = self.gate.reserve()
+        self.stats.record(wait)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+async def fetch_trades_async(exchange: ccxt.async_support.Exchange, market: str, since: int, last_eid: str,
+                             token: Optional[str] = None) -> list:
+    pager = page_trades(exchange.id, market, since, exchange.milliseconds(), last_eid, token)
+    with metrics.timer('trade_fetch'):
+        try:
+            request = next(pager)
+            while True:
+                metrics.inc('requests')
+                request = pager.send(await exchange.fetch_trades(**request))
+        except StopIteration as stop:
+            metrics.inc('trades', len(stop.value))
+            return stop.value
+
+
+class AsyncEngine:
+    """Single event loop serving every exchange; network calls are awaited, DB work runs on a thread pool."""
+
+    def __init__(self, args: Namespace):
+        self.args = args
+        self.poll = make_poll(args)
+        self.retry = RetryPolicy()
+        self.db_pool = ThreadPoolExecutor(max_workers=args.workers)
+        self.slots = {}
+        self.running = set()
+        self.tasks = set()
+
+    async def db(self, fn, *args):
+        # the copied context carries the metrics labels of the calling task
+        return await asyncio.get_running_loop().run_in_executor(self.db_pool,
+                                                                partial(contextvars.copy_context().run, fn, *args))
+
+    async def snap_book(self, session, exchange, em, symbol: str, ts: datetime.datetime):
+        logging.info('{}::{} snap book'.format(exchange.id, symbol))
+        if not await self.db(book_exists, session, em, ts):
+            with metrics.timer('book_fetch'):
+                metrics.inc('requests')
+                bo = await exchange.fetch_order_book(symbol, limit=book_limit(exchange), params=book_params(exchange))
+            with metrics.timer('book_write'):
+                await self.db(store_book, session, em, ts, bo, self.args.book_storage)
+
+    async def snap_trades(self, session, exchange, em, symbol: str, key: tuple):
+        logging.info('{}::{} snap trades'.format(exchange.id, symbol))
+        (since, last_eid, token) = await self.db(trade_cursor, session, exchange, em)
+        trades_all = await fetch_trades_async(exchange, symbol, since, last_eid, token)
+        await self.db(store_trades, session, exchange, em, symbol, trades_all)
+        if self.poll:
+            self.poll.update(key, len(trades_all), page_strategy(exchange.id).depth)
+        logging.info('{}::{} end'.format(exchange.id, symbol))
+
+    async def snap(self, exchange: ccxt.async_support.Exchange, market: dict, ts: datetime.datetime,
+                   snap_target: Optional[SnapTarget] = None):
+        """One snap attempt of a market, book and trades tried independently like bdata.snap."""
+        base = market['base']
+        quote = market['quote']
+        symbol = base + '/' + quote
+        key = (exchange.id, market['symbol'])
+        failed = {}
+        session = Session()
+        em = None
+        try:
+            (e, em, bt, qt) = await self.db(ensure_exchange_market, session, exchange, base, quote)
+            if em.disabled:
+                return
+            for part in snap_parts(exchange, market, snap_target or self.args.snap_target, self.retry):
+                if part == SnapTarget.TRADE and self.poll and not self.poll.due(key):
+                    continue
+                try:
+                    if part == SnapTarget.BOOK:
+                        await self.snap_book(session, exchange, em, symbol, ts)
+                    else:
+                        await self.snap_trades(session, exchange, em, symbol, key)
+                    self.retry.success(part_key(exchange, market, part))
+                except Exception as e:
+                    await self.db(snap_failed, session, exchange, market, em, e, self.retry, part)
+                    failed[part] = e
+        except Exception as e:
+            await self.db(snap_failed, session, exchange, market, em, e, self.retry)
+            raise
+        finally:
+            await self.db(session.close)
+        if failed:
+            raise snap_error(failed)
+
+    async def lane(self, exchange, market: dict, ts: datetime.datetime, deadline: datetime.datetime):
+        """Snaps a market, failed attempts back off without holding the exchange slot."""
+        key = (exchange.id, market['symbol'])
+        attempt = 0
+        kwargs = {}
+        while True:
+            async with self.slots[exchange.id]:
+                if key in self.running or datetime.datetime.now() >= deadline:
+                    metrics.inc('skipped', labels=key)
+                    logging.warning('{}::{} skipped, cycle ts={} overrun'.format(exchange.id, market['symbol'], ts))
+                    return
+                self.running.add(key)
+                try:
+                    with metrics.labels(*key), metrics.timer('snap'):
+                        await self.snap(exchange, market, ts, **kwargs)
+                    return
+                except Exception as e:
+                    delay = self.retry.delay(classify(e), attempt)
+                    kwargs = getattr(e, 'retry_kwargs', kwargs)
+                finally:
+                    self.running.discard(key)
+            if delay is None or datetime.datetime.now() + datetime.timedelta(seconds=delay) >= deadline:
+                return
+            metrics.inc('retries', labels=key)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def load(self, name: str, cfg: dict):
+        exchange = create_exchange(getattr(ccxt.async_support, name))
+        if not exchange_filter(exchange):
+            await exchange.close()
+            return None
+        try:
+            shared = self.args.rate_scope == RateScope.SHARED
+            if 'proxies' in cfg:
+                exchange.proxies = cfg['proxies']
+            exchange.enableRateLimit = 'proxies' not in cfg or shared
+            if exchange.enableRateLimit:
+                exchange.throttle = AsyncRateGate(rate_gate(exchange, shared))
+            if not use_markets_cache(exchange):
+                await exchange.load_markets()
+                write_markets_cache(exchange)
+            exchange.timeout = 60000
+            return exchange
+        except Exception as e:
+            logging.error('{} error {}'.format(exchange.id, str(e)))
+            await exchange.close()
+            return None
+
+    async def refresh_markets(self, exchange):
+        try:
+            await exchange.load_markets(reload=True)
+            write_markets_cache(exchange)
+            logging.info('{} markets refreshed'.format(exchange.id))
+        except Exception as e:
+            logging.error('{} markets refresh error {}'.format(exchange.id, str(e)))
+
+    async def run(self, exchange_list: list, cfg: dict, market_filter: Callable[[dict], bool],
+                  last_ts: Callable[[], datetime.datetime]):
+        loaded = [r for r in await asyncio.gather(*[self.load(name, cfg) for name in exchange_list]) if r]
+        if len(loaded) == 0:
+            logging.error('exchanges list is empty')
+            return
+        for exchange in loaded:
+            self.slots[exchange.id] = asyncio.Semaphore(max(1, self.args.exchange_workers))
+        try:
+            ts = last_ts()
+            stats_log_ts = time.time()
+            while True:
+                if datetime.datetime.now() > ts:
+                    current_ts = ts
+                    ts = last_ts() + datetime.timedelta(seconds=self.args.interval)
+                    logging.info('start snap ts={}'.format(current_ts))
+                    metrics.set('cycle_start_lag_seconds', (datetime.datetime.now() - current_ts).total_seconds())
+                    if time.time() - stats_log_ts > STATS_LOG_INTERVAL:
+                        stats_log_ts = time.time()
+                        log_stats(loaded)
+                    for exchange in loaded:
+                        if time.time() - markets_ts.get(exchange.id, 0) > MARKETS_CACHE_TTL:
+                            markets_ts[exchange.id] = time.time()
+                            task = asyncio.ensure_future(self.refresh_markets(exchange))
+                            self.tasks.add(task)
+                            task.add_done_callback(self.tasks.discard)
+                        for market in list(exchange.markets.values()):
+                            if market_filter(market):
+                                task = asyncio.ensure_future(self.lane(exchange, market, current_ts, ts))
+                                self.tasks.add(task)
+                                task.add_done_callback(self.tasks.discard)
+                else:
+                    await asyncio.sleep(0.1)
+        finally:
+            await asyncio.gather(*[exchange.close() for exchange in loaded])
+            self.db_pool.shutdown()
@@ -0,0 +1,383 @@
+import bisect
+import datetime
+import json
+import logging
+import random
+import resource
+import sys
+import time
+from argparse import ArgumentParser, Namespace
+from copy import deepcopy
+from functools import partial
+from types import SimpleNamespace
+from typing import Optional
+
+import ccxt
+import numpy as np
+import pandas as pd
+from sqlalchemy import func, text
+
+from bdata_agg import ohlcv_apply, ohlcv_split
+from bdata_db import Session
+from bdata_model import Trade, Trade1M, BookSnap, ExchangeMarket
+from bdata_page import PageStrategy, BinancePaging, TRADES_LIMIT, HOUR_MS
+from bdata_partition import month_ms
+from bdata_retry import RetryPolicy
+from bdata_snap import ensure_exchange_market, add_trades_orm, add_trades_bulk, store_book, BookStorage, BINANCE, \
+    snap, snap_trades, snap_book, decimalize, SnapTarget
+from bdata_stat import make_stat_step_book, make_stat_step_book_np, make_stat_step_trade, make_stat_step_trade_set
+
+BENCH_EXCHANGE = 'bench'
+# midnight UTC starting the current month, trade_cursor starts a market without history at the start of the
+# exchange's current day; trades in the current month land in an existing trade partition
+BENCH_DAY = month_ms(datetime.datetime.utcnow().year, datetime.datetime.utcnow().month)
+
+
+def synthetic_trades(n: int, start_ts: int = BENCH_DAY, seed: int = 0, gap: int = 2000) -> list:
+    rnd = random.Random(seed)
+    price = 0.05
+    trades = []
+    ts = start_ts
+    for i in range(n):
+        ts += rnd.randint(0, gap)
+        price = round(price * (1 + rnd.gauss(0, 0.0005)), 8)
+        trades.append({'id': str(i), 'timestamp': ts, 'side': rnd.choice(['buy', 'sell']), 'price': price,
+                       'amount': round(rnd.expovariate(1.0), 8)})
+    return trades
+
+
+def synthetic_book(levels: int, mid: float = 0.05, seed: int = 0) -> dict:
+    rnd = random.Random(seed)
+    tick = mid / 10000
+    return {'bids': [[round(mid - tick * (i + 1), 8), round(rnd.expovariate(1.0), 8)] for i in range(levels)],
+            'asks': [[round(mid + tick * (i + 1), 8), round(rnd.expovariate(1.0), 8)] for i in range(levels)]}
+
+
+def bench_market(session):
+    return ensure_exchange_market(session, SimpleNamespace(id=BENCH_EXCHANGE), 'BASE', 'QUOTE')[1]
+
+
+def db_function(session, name: str) -> bool:
+    return session.execute(text('select to_regproc(:name) is not null'), {'name': name}).scalar()
+
+
+def skip_variant(session, bench_name: str, name: str, function: Optional[str]) -> bool:
+    """True when the variant needs a database function not installed, those are maintained outside this repo."""
+    if function is None or db_function(session, function):
+        return False
+    logging.warning('{} {} skipped, function {} not in the database'.format(bench_name, name, function))
+    return True
+
+
+def bench_store_trades(args: Namespace):
+    session = Session()
+    try:
+        em = bench_market(session)
+        for (name, fn) in [('orm', add_trades_orm), ('bulk', add_trades_bulk)]:
+            trades = synthetic_trades(args.rows)
+            t = time.perf_counter()
+            fn(session, em, trades)
+            session.commit()
+            t = time.perf_counter() - t
+            logging.info('store_trades {} rows={} time={:.3f}s {:.0f} rows/s'.format(name, args.rows, t, args.rows / t))
+            session.query(Trade).filter(Trade.exchange_market_id == em.exchange_market_id).delete()
+            session.commit()
+    finally:
+        session.close()
+
+
+def bench_stat_book(args: Namespace):
+    session = Session()
+    try:
+        em = bench_market(session)
+        mts = datetime.datetime(2020, 1, 1)
+        markets = [em.exchange_market_id]
+        for (name, fn, function) in [('sql', partial(make_stat_step_book, markets), 'booksnapstat'),
+                                     ('numpy', partial(make_stat_step_book_np, markets=markets), None)]:
+            if skip_variant(session, 'stat_book', name, function):
+                continue
+            for i in range(args.books):
+                store_book(session, em, mts + datetime.timedelta(minutes=i), synthetic_book(args.levels, seed=i),
+                           BookStorage.ARRAY)
+            t = time.perf_counter()
+            while session.query(BookSnap).filter(BookSnap.exchange_market_id == em.exchange_market_id,
+                                                 BookSnap.stat.is_(False)).count() > 0:
+                fn()
+            t = time.perf_counter() - t
+            logging.info('stat_book {} books={} levels={} time={:.3f}s {:.1f} books/s'.format(
+                name, args.books, args.levels, t, args.books / t))
+            session.query(BookSnap).filter(BookSnap.exchange_market_id == em.exchange_market_id).delete()
+            session.commit()
+    finally:
+        session.close()
+
+
+def synthetic_frame(trades: list) -> pd.DataFrame:
+    return pd.DataFrame({'side': ['B' if e['side'] == 'buy' else 'S' for e in trades],
+                         'price': [e['price'] for e in trades],
+                         'amount': [e['amount'] for e in trades]},
+                        index=pd.to_datetime([e['timestamp'] for e in trades], unit='ms'))
+
+
+def bench_ohlcv(args: Namespace):
+    df = synthetic_frame(synthetic_trades(args.rows))
+    for (name, fn) in [('apply', ohlcv_apply), ('vectorized', ohlcv_split)]:
+        t = time.perf_counter()
+        bars = fn(df, '1min')
+        t = time.perf_counter() - t
+        logging.info('ohlcv {} rows={} bars={} time={:.3f}s {:.0f} rows/s'.format(
+            name, args.rows, len(bars), t, args.rows / t))
+
+
+class FakeExchange(ccxt.Exchange):
+    """Deterministic offline exchange: serves fetch_trades from a list of synthetic trades, the same for every
+    symbol, and synthetic books of up to levels levels; counts requests.
+
+    window is the longest since..endTime span the exchange accepts (binance aggTrades: one hour), None when since
+    alone is honoured. Like binance, a bounded window holding more than limit trades returns its last limit trades.
+    Trade ids are list positions, so fromId works as on binance.
+    """
+
+    def __init__(self, exchange_id: str, trades: list, window: Optional[int] = None, default_limit: int = 500,
+                 max_limit: int = 1000, levels: int = 5000):
+        super().__init__()
+        self.id = exchange_id
+        self.trades = trades
+        self.levels = levels
+        self.ts = [e['timestamp'] for e in trades]
+        self.window = window
+        self.default_limit = default_limit
+        self.max_limit = max_limit
+        self.requests = 0
+
+    def milliseconds(self) -> int:
+        return self.ts[-1] + 1 if self.ts else 0
+
+    def fetch_trades(self, symbol: str, since: Optional[int] = None, limit: Optional[int] = None,
+                     params: Optional[dict] = None) -> list:
+        self.requests += 1
+        params = params or {}
+        limit = min(limit or self.default_limit, self.max_limit)
+        if 'fromId' in params:
+            lo = int(params['fromId'])
+            return self.trades[lo:lo + limit]
+        if since is None:
+            return self.trades[-limit:]
+        lo = bisect.bisect_left(self.ts, since)
+        end = params.get('endTime', since + self.window if self.window else None)
+        if end is None:
+            return self.trades[lo:lo + limit]
+        hi = bisect.bisect_right(self.ts, end)
+        return self.trades[max(lo, hi - limit):hi]
+
+    def fetch_order_book(self, symbol: str, limit: Optional[int] = None, params: Optional[dict] = None) -> dict:
+        self.requests += 1
+        return synthetic_book(min(limit or self.levels, self.levels), seed=self.requests)
+
+
+def legacy_binance_pages(market: str, since: int, max_ts: int, last_eid: str, token: Optional[str]):
+    """The 55 minute window heuristic page_trades used for binance before pagination strategies."""
+    trades_all = []
+    trades_prior = None
+    while since < max_ts and len(trades_all) < TRADES_LIMIT:
+        trades_tmp = yield dict(symbol=market, since=since)
+        if json.dumps(trades_prior, sort_keys=True) == json.dumps(trades_tmp, sort_keys=True):
+            since += 55 * 60 * 1000
+        else:
+            if len(trades_tmp) > 0:
+                trades_all += trades_tmp
+                since = trades_tmp[-1]['timestamp']
+            else:
+                since += 55 * 60 * 1000
+        trades_prior = deepcopy(trades_tmp)
+    return trades_all
+
+
+def drive(exchange: FakeExchange, pager) -> list:
+    try:
+        request = next(pager)
+        while True:
+            request = pager.send(exchange.fetch_trades(**request))
+    except StopIteration as stop:
+        return stop.value
+
+
+def bench_paging(args: Namespace):
+    """Requests per trade fetched of each pagination strategy over a busy and a quiet synthetic market."""
+    markets = [('busy', synthetic_trades(args.rows)), ('quiet', synthetic_trades(args.rows // 100, gap=3 * HOUR_MS))]
+    for (market, trades) in markets:
+        since = trades[0]['timestamp']
+        runs = [('binance legacy', FakeExchange(BINANCE, trades, HOUR_MS), legacy_binance_pages, None),
+                ('binance window', FakeExchange(BINANCE, trades, HOUR_MS), BinancePaging(1000).pages, None),
+                ('binance fromId', FakeExchange(BINANCE, trades, HOUR_MS), BinancePaging(1000).pages, '0'),
+                ('since', FakeExchange('generic', trades), PageStrategy().pages, None)]
+        for (name, exchange, pages, token) in runs:
+            t = time.perf_counter()
+            fetched = drive(exchange, pages('BASE/QUOTE', since, exchange.milliseconds(), '', token))
+            t = time.perf_counter() - t
+            n = len({e['id'] for e in fetched})
+            logging.info('paging {} {} trades={}/{} requests={} requests/1k trades={:.1f} time={:.3f}s'.format(
+                market, name, n, len(trades), exchange.requests, exchange.requests * 1000 / max(n, 1), t))
+            # no hole up to the last trade fetched, a poll capped at TRADES_LIMIT resumes from its cursor; the
+            # legacy heuristic is the baseline and known to lose trades
+            ids = {int(e['id']) for e in fetched}
+            missing = max(ids, default=-1) + 1 - len(ids)
+            if pages != legacy_binance_pages and (missing or not ids):
+                raise AssertionError('paging {} {} lost {} trades'.format(market, name, missing))
+
+
+def percentiles(samples: list) -> str:
+    (p50, p95, p99) = np.percentile(np.array(samples) * 1000, [50, 95, 99]) if samples else (0, 0, 0)
+    return 'p50={:.1f}ms p95={:.1f}ms p99={:.1f}ms'.format(p50, p95, p99)
+
+
+def peak_rss() -> str:
+    # ru_maxrss is in kilobytes on linux, the peak of the whole run so far
+    return 'peak_rss={:.0f}MB'.format(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def bench_markets(session, exchange: ccxt.Exchange, n: int) -> list:
+    """n markets of exchange with empty trade and book history and no fetch cursor."""
+    markets = []
+    for i in range(n):
+        market = {'symbol': 'B{}/QUOTE'.format(i), 'base': 'B{}'.format(i), 'quote': 'QUOTE'}
+        em = ensure_exchange_market(session, exchange, market['base'], market['quote'])[1]
+        clear_market(session, em)
+        markets.append((market, em))
+    return markets
+
+
+def clear_market(session, em):
+    session.query(Trade).filter(Trade.exchange_market_id == em.exchange_market_id).delete()
+    session.query(Trade1M).filter(Trade1M.exchange_market_id == em.exchange_market_id).delete()
+    # levels, sides and stats go with their book_snap by on delete cascade
+    session.query(BookSnap).filter(BookSnap.exchange_market_id == em.exchange_market_id).delete()
+    session.query(ExchangeMarket).filter(ExchangeMarket.exchange_market_id == em.exchange_market_id). \
+        update({ExchangeMarket.trade_ts: None, ExchangeMarket.trade_eid: None, ExchangeMarket.trade_token: None},
+               synchronize_session=False)
+    session.commit()
+    (em.trade_ts, em.trade_eid, em.trade_token) = (None, None, None)
+
+
+def run_snaps(args: Namespace, name: str, fn):
+    """Runs fn(session, exchange, market, ts) once per market against a fake exchange and logs throughput."""
+    exchange = FakeExchange(BENCH_EXCHANGE, synthetic_trades(args.rows // args.markets, start_ts=BENCH_DAY),
+                            levels=args.levels)
+    session = Session()
+    try:
+        markets = bench_markets(session, exchange, args.markets)
+        ts = datetime.datetime(2020, 1, 1)
+        samples = []
+        start = time.perf_counter()
+        for (market, em) in markets:
+            t = time.perf_counter()
+            fn(session, exchange, market, ts)
+            samples.append(time.perf_counter() - t)
+        total = time.perf_counter() - start
+        trades = session.query(Trade).filter(Trade.exchange_market_id.in_([em.exchange_market_id
+                                                                           for (m, em) in markets])).count()
+        logging.info('{} markets={} levels={} trades={} time={:.3f}s {:.1f} snaps/s {:.0f} trades/s {} '
+                     'requests={} {}'.format(name, args.markets, args.levels, trades, total, len(markets) / total,
+                                             trades / total, percentiles(samples), exchange.requests, peak_rss()))
+        for (market, em) in markets:
+            clear_market(session, em)
+    finally:
+        session.close()
+
+
+def bench_snap(args: Namespace):
+    run_snaps(args, 'snap', lambda session, exchange, market, ts: snap(
+        exchange, market, ts, SnapTarget.ALL, BookStorage(args.book_storage), poll=None, retry=RetryPolicy()))
+
+
+def bench_snap_trades(args: Namespace):
+    run_snaps(args, 'snap_trades', lambda session, exchange, market, ts: snap_trades(
+        session, ts, exchange, market['base'], market['quote']))
+
+
+def bench_snap_book(args: Namespace):
+    run_snaps(args, 'snap_book', lambda session, exchange, market, ts: snap_book(
+        session, ts, exchange, market['base'], market['quote'], BookStorage(args.book_storage)))
+
+
+def bench_decimalize(args: Namespace):
+    books = [synthetic_book(args.levels, seed=i) for i in range(args.books)]
+    samples = []
+    for book in books:
+        t = time.perf_counter()
+        decimalize(book)
+        samples.append(time.perf_counter() - t)
+    logging.info('decimalize books={} levels={} {:.1f} books/s {} {}'.format(
+        args.books, args.levels, len(books) / sum(samples), percentiles(samples), peak_rss()))
+
+
+def bench_stat_trade(args: Namespace):
+    session = Session()
+    try:
+        em = bench_market(session)
+        for (name, fn, function) in [('loop', make_stat_step_trade, 'tradeohlc'),
+                                     ('set', make_stat_step_trade_set, None)]:
+            if skip_variant(session, 'stat_trade', name, function):
+                continue
+            clear_market(session, em)
+            trades = synthetic_trades(args.rows)
+            add_trades_bulk(session, em, trades)
+            session.query(ExchangeMarket).filter(ExchangeMarket.exchange_market_id == em.exchange_market_id). \
+                update({ExchangeMarket.trade_ts: trades[-1]['timestamp']}, synchronize_session=False)
+            session.commit()
+            samples = []
+            while True:
+                t = time.perf_counter()
+                fn([em.exchange_market_id])
+                samples.append(time.perf_counter() - t)
+                bars = session.query(Trade1M).filter(Trade1M.exchange_market_id == em.exchange_market_id).count()
+                last = session.query(func.max(Trade1M.dt)). \
+                    filter(Trade1M.exchange_market_id == em.exchange_market_id).scalar()
+                if last is None or last >= datetime.datetime.utcfromtimestamp(trades[-1]['timestamp'] / 1000) - \
+                        datetime.timedelta(minutes=2) or len(samples) > 1000:
+                    break
+            logging.info('stat_trade {} rows={} bars={} steps={} time={:.3f}s {:.0f} bars/s {} {}'.format(
+                name, args.rows, bars, len(samples), sum(samples), bars / sum(samples), percentiles(samples),
+                peak_rss()))
+        clear_market(session, em)
+    finally:
+        session.close()
+
+
+BENCHMARKS = {
+    'store_trades': bench_store_trades,
+    'stat_book': bench_stat_book,
+    'ohlcv': bench_ohlcv,
+    'paging': bench_paging,
+    'snap': bench_snap,
+    'snap_trades': bench_snap_trades,
+    'snap_book': bench_snap_book,
+    'decimalize': bench_decimalize,
+    'stat_trade': bench_stat_trade,
+}
+
+
+def bench():
+    parser = ArgumentParser()
+    parser.add_argument('benchmark', nargs='*', choices=list(BENCHMARKS))
+    parser.add_argument('--rows', default=100000, type=int)
+    parser.add_argument('--books', default=200, type=int)
+    parser.add_argument('--levels', default=5000, type=int)
+    parser.add_argument('--markets', default=20, type=int)
+    parser.add_argument('--book_storage', choices=[s.value for s in BookStorage], default=BookStorage.ROWS.value)
+    args = parser.parse_args()
+    failed = []
+    for name in args.benchmark or list(BENCHMARKS):
+        try:
+            BENCHMARKS[name](args)
+        except Exception as e:
+            logging.error('{} failed {} {}'.format(name, type(e).__name__, e))
+            failed.append(name)
+    if failed:
+        sys.exit('failed benchmarks: {}'.format(', '.join(failed)))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
+                        datefmt='%Y-%m-%d %H:%M:%S')
+    bench()
@@ -0,0 +1,131 @@
+import logging
+import threading
+import time
+from typing import Optional, Tuple
+
+from sqlalchemy.dialects.postgresql import insert
+
+from bdata_model import Exchange, Token, ExchangeMarket
+
+REFRESH_INTERVAL = 300
+
+
+class ExchangeRef:
+    __slots__ = ('exchange_id', 'symbol')
+
+    def __init__(self, exchange_id: int, symbol: str):
+        self.exchange_id = exchange_id
+        self.symbol = symbol
+
+
+class TokenRef:
+    __slots__ = ('token_id', 'symbol')
+
+    def __init__(self, token_id: int, symbol: str):
+        self.token_id = token_id
+        self.symbol = symbol
+
+
+class ExchangeMarketRef:
+    __slots__ = ('exchange_market_id', 'exchange_id', 'base_token_id', 'quote_token_id', 'trade_ts', 'trade_eid',
+                 'trade_token', 'disabled')
+
+    def __init__(self, exchange_market_id: int, exchange_id: int, base_token_id: int, quote_token_id: int,
+                 trade_ts: Optional[int], trade_eid: Optional[str], trade_token: Optional[str],
+                 disabled: Optional[bool]):
+        self.exchange_market_id = exchange_market_id
+        self.exchange_id = exchange_id
+        self.base_token_id = base_token_id
+        self.quote_token_id = quote_token_id
+        self.trade_ts = trade_ts
+        self.trade_eid = trade_eid
+        self.trade_token = trade_token
+        self.disabled = disabled
+
+    def __repr__(self):
+        return 'ExchangeMarketRef({})'.format(self.exchange_market_id)
+
+
+def upsert(session, table, values: dict, index_elements: list, *returning):
+    key = index_elements[0]
+    stmt = insert(table).values(**values). \
+        on_conflict_do_update(index_elements=index_elements, set_={key: values[key]}). \
+        returning(*returning)
+    return session.execute(stmt).first()
+
+
+class MarketCache:
+    """Process wide exchange/token/exchange_market id mapping, misses are resolved with one upsert each."""
+
+    def __init__(self, refresh_interval: int = REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.lock = threading.Lock()
+        self.exchanges = {}
+        self.tokens = {}
+        self.markets = {}
+        self.next_refresh = 0.0
+
+    def load(self, session):
+        with self.lock:
+            for e in session.query(Exchange.exchange_id, Exchange.symbol):
+                self.exchanges[e.symbol] = ExchangeRef(e.exchange_id, e.symbol)
+            for t in session.query(Token.token_id, Token.symbol):
+                self.tokens[t.symbol] = TokenRef(t.token_id, t.symbol)
+            for em in session.query(ExchangeMarket.exchange_market_id, ExchangeMarket.exchange_id,
+                                    ExchangeMarket.base_token_id, ExchangeMarket.quote_token_id,
+                                    ExchangeMarket.trade_ts, ExchangeMarket.trade_eid, ExchangeMarket.trade_token,
+                                    ExchangeMarket.disabled):
+                self.markets[(em.exchange_id, em.base_token_id, em.quote_token_id)] = ExchangeMarketRef(*em)
+            self.next_refresh = time.monotonic() + self.refresh_interval
+        logging.info('market cache loaded exchanges={} tokens={} markets={}'.format(
+            len(self.exchanges), len(self.tokens), len(self.markets)))
+
+    def refresh(self, session):
+        disabled = dict(session.query(ExchangeMarket.exchange_market_id, ExchangeMarket.disabled))
+        with self.lock:
+            for em in self.markets.values():
+                if em.exchange_market_id in disabled:
+                    em.disabled = disabled[em.exchange_market_id]
+
+    def exchange(self, session, symbol: str) -> ExchangeRef:
+        e = self.exchanges.get(symbol)
+        if not e:
+            row = upsert(session, Exchange.__table__, {'symbol': symbol}, ['symbol'], Exchange.exchange_id)
+            session.commit()
+            with self.lock:
+                e = self.exchanges.setdefault(symbol, ExchangeRef(row.exchange_id, symbol))
+        return e
+
+    def token(self, session, symbol: str) -> TokenRef:
+        t = self.tokens.get(symbol)
+        if not t:
+            row = upsert(session, Token.__table__, {'symbol': symbol}, ['symbol'], Token.token_id)
+            session.commit()
+            with self.lock:
+                t = self.tokens.setdefault(symbol, TokenRef(row.token_id, symbol))
+        return t
+
+    def ensure(self, session, exchange: str, base: str, quote: str) \
+            -> Tuple[ExchangeRef, ExchangeMarketRef, TokenRef, TokenRef]:
+        if time.monotonic() >= self.next_refresh:
+            self.next_refresh = time.monotonic() + self.refresh_interval
+            self.refresh(session)
+        e = self.exchange(session, exchange)
+        bt = self.token(session, base)
+        qt = self.token(session, quote)
+        key = (e.exchange_id, bt.token_id, qt.token_id)
+        em = self.markets.get(key)
+        if not em:
+            row = upsert(session, ExchangeMarket.__table__,
+                         {'exchange_id': e.exchange_id, 'base_token_id': bt.token_id, 'quote_token_id': qt.token_id},
+                         ['exchange_id', 'base_token_id', 'quote_token_id'],
+                         ExchangeMarket.exchange_market_id, ExchangeMarket.trade_ts, ExchangeMarket.trade_eid,
+                         ExchangeMarket.trade_token, ExchangeMarket.disabled)
+            session.commit()
+            with self.lock:
+                em = self.markets.setdefault(key, ExchangeMarketRef(row.exchange_market_id, *key, row.trade_ts,
+                                                                    row.trade_eid, row.trade_token, row.disabled))
+        return e, em, bt, qt
+
+
+market_cache = MarketCache()
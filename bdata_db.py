@@ -1,9 +1,11 @@
+import io
 import json
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.pool import NullPool
 
+from bdata_metrics import metrics
 from bdata_model import Base
 
 cfg = json.loads(open('config.json').read())
@@ -11,6 +13,77 @@ cfg = json.loads(open('config.json').read())
 engine = create_engine(cfg['db'], echo=False, echo_pool=False, poolclass=NullPool)
 Session = sessionmaker(bind=engine)
 
+# NOTIFY channels carrying the exchange_market_id of new book snaps and trades
+BOOK_CHANNEL = 'bdata_book'
+TRADE_CHANNEL = 'bdata_trade'
+
+
+def copy_value(v) -> str:
+    if v is None:
+        return '\\N'
+    return str(v).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def copy_rows(session, table, columns: list, rows: list, ignore_conflicts: bool = False) -> int:
+    """Streams rows into table with COPY inside the session's current transaction, returns rows inserted.
+
+    With ignore_conflicts rows are copied into a temp staging table and moved with on conflict do nothing.
+    """
+    connection = session.connection()
+    if connection.dialect.name != 'postgresql':
+        insert = table.insert().prefix_with('or ignore') if ignore_conflicts else table.insert()
+        return connection.execute(insert, [dict(zip(columns, row)) for row in rows]).rowcount
+    buf = io.StringIO()
+    for row in rows:
+        buf.write('\t'.join(copy_value(v) for v in row))
+        buf.write('\n')
+    buf.seek(0)
+    cols = ', '.join(columns)
+    with connection.connection.cursor() as cursor:
+        if not ignore_conflicts:
+            cursor.copy_expert('copy {} ({}) from stdin'.format(table.name, cols), buf)
+            return cursor.rowcount
+        stage = table.name + '_stage'
+        cursor.execute('create temp table if not exists {} on commit drop as select {} from {} with no data'.
+                       format(stage, cols, table.name))
+        cursor.copy_expert('copy {} ({}) from stdin'.format(stage, cols), buf)
+        with metrics.timer(table.name + '_dedup'):
+            cursor.execute('insert into {0} ({1}) select {1} from {2} on conflict do nothing'.
+                           format(table.name, cols, stage))
+        n = cursor.rowcount
+        cursor.execute('truncate {}'.format(stage))
+        return n
+
+
+def notify(session, channel: str, payload: str):
+    """Queues a NOTIFY on the session's transaction, listeners get it once the transaction commits."""
+    connection = session.connection()
+    if connection.dialect.name == 'postgresql':
+        connection.execute(text('select pg_notify(:channel, :payload)'), {'channel': channel, 'payload': payload})
+
+
+# level views over the row and array book storage modes
+BOOK_VIEWS = [('vbook_snap_bid', 'book_snap_bid', 'B'), ('vbook_snap_ask', 'book_snap_ask', 'A')]
+
+
+def create_book_views(connection):
+    for (view, table, side) in BOOK_VIEWS:
+        connection.execute(text(f"""
+            create or replace view {view} as
+            select book_snap_id, price, amount
+            from {table}
+            union all
+            select s.book_snap_id, u.price, u.amount
+            from book_snap_side s,
+                unnest(s.price, s.amount) u(price, amount)
+            where s.side = '{side}'"""))
+
+
 if __name__ == '__main__':
     Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        create_book_views(connection)
+    # trade is partitioned, create_all leaves it without partitions
+    from bdata_partition import ensure_trade_partitions
+    ensure_trade_partitions()
 
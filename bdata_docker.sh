@@ -5,14 +5,14 @@ EXCHANGES='bitfinex binance bittrex kraken hitbtc huobipro poloniex kucoin bitfl
 case $1 in
 run)
   for EXCHANGE in $EXCHANGES; do
-    docker run -itd --name="bdata_""$EXCHANGE""_all_btc" --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=$EXCHANGE --base=* --quote=BTC --snap_target=trade
+    docker run -itd --name="bdata_""$EXCHANGE""_all_btc" --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=$EXCHANGE --base=* --quote=BTC --snap_target=trade --rate_scope=shared
   done
-  docker run -itd --name=bdata_all_btc_usd --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=BTC --quote=USD --snap_target=trade
-  docker run -itd --name=bdata_all_btc_eur --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=BTC --quote=EUR --snap_target=trade
-  docker run -itd --name=bdata_all_btc_usdt --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=BTC --quote=USDT --snap_target=trade
-  docker run -itd --name=bdata_all_nano_btc --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=NANO --quote=BTC --snap_target=all
-  docker run -itd --name=bdata_coinbasepro_btc_usd_book --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=coinbasepro --base=BTC --quote=USD --snap_target=book
-  docker run -itd --name=bdata_binance_all_bnb --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=30 --exchange=binance --base=* --quote=BNB --snap_target=trade
+  docker run -itd --name=bdata_all_btc_usd --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=BTC --quote=USD --snap_target=trade --rate_scope=shared
+  docker run -itd --name=bdata_all_btc_eur --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=BTC --quote=EUR --snap_target=trade --rate_scope=shared
+  docker run -itd --name=bdata_all_btc_usdt --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=BTC --quote=USDT --snap_target=trade --rate_scope=shared
+  docker run -itd --name=bdata_all_nano_btc --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=* --base=NANO --quote=BTC --snap_target=all --rate_scope=shared
+  docker run -itd --name=bdata_coinbasepro_btc_usd_book --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=60 --exchange=coinbasepro --base=BTC --quote=USD --snap_target=book --rate_scope=shared
+  docker run -itd --name=bdata_binance_all_bnb --restart=unless-stopped --memory=1g -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata.py --interval=30 --exchange=binance --base=* --quote=BNB --snap_target=trade --rate_scope=shared
   docker run -itd --name=bdata_agent --restart=unless-stopped -v /home/bot/bdata/config.json:/app/config.json bdata python -OO bdata_stat.py
   ;;
 
@@ -0,0 +1,134 @@
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional, Tuple
+
+LABEL_NAMES = ('exchange', 'market')
+
+# /metrics bind address: all interfaces inside a container so the port can be published, loopback elsewhere
+METRICS_HOST = '0.0.0.0' if os.path.exists('/.dockerenv') else '127.0.0.1'
+
+# (exchange, market) of the snap running in this thread or task
+current_labels: ContextVar[Tuple[str, ...]] = ContextVar('current_labels', default=())
+
+
+class Metrics:
+    """Process wide timings, counters and gauges labelled by exchange and market, rendered in the Prometheus text
+    format. Timings keep count, sum and max per label set."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.counters = {}
+        self.gauges = {}
+
+    @contextmanager
+    def labels(self, exchange: str, market: Optional[str] = None):
+        token = current_labels.set((exchange, market) if market else (exchange,))
+        try:
+            yield
+        finally:
+            current_labels.reset(token)
+
+    def observe(self, name: str, seconds: float, labels: Optional[tuple] = None):
+        key = (name, current_labels.get() if labels is None else labels)
+        with self.lock:
+            t = self.timings.get(key)
+            if t is None:
+                self.timings[key] = [1, seconds, seconds]
+            else:
+                t[0] += 1
+                t[1] += seconds
+                t[2] = max(t[2], seconds)
+
+    @contextmanager
+    def timer(self, name: str, labels: Optional[tuple] = None):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t, labels)
+
+    def inc(self, name: str, n: float = 1, labels: Optional[tuple] = None):
+        key = (name, current_labels.get() if labels is None else labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+
+    def set(self, name: str, value: float, labels: tuple = ()):
+        with self.lock:
+            self.gauges[(name, labels)] = value
+
+    def render(self) -> str:
+        def fmt(labels: tuple) -> str:
+            if not labels:
+                return ''
+            return '{' + ','.join('{}="{}"'.format(k, v.replace('"', '\\"'))
+                                  for (k, v) in zip(LABEL_NAMES, labels)) + '}'
+
+        lines = []
+        with self.lock:
+            for (name, labels), (count, total, peak) in sorted(self.timings.items()):
+                lines.append('bdata_{}_seconds_count{} {}'.format(name, fmt(labels), count))
+                lines.append('bdata_{}_seconds_sum{} {:.6f}'.format(name, fmt(labels), total))
+                lines.append('bdata_{}_seconds_max{} {:.6f}'.format(name, fmt(labels), peak))
+            for (name, labels), v in sorted(self.counters.items()):
+                lines.append('bdata_{}_total{} {}'.format(name, fmt(labels), v))
+            for (name, labels), v in sorted(self.gauges.items()):
+                lines.append('bdata_{}{} {}'.format(name, fmt(labels), v))
+        return '\n'.join(lines) + '\n'
+
+    def log_summary(self):
+        """One line per exchange, slowest first: snaps, mean fetch/write/commit time, requests per trade, retries."""
+        per = {}
+        with self.lock:
+            for (name, labels), (count, total, peak) in self.timings.items():
+                if labels:
+                    t = per.setdefault(labels[0], {}).setdefault(name, [0, 0.0])
+                    t[0] += count
+                    t[1] += total
+            for (name, labels), v in self.counters.items():
+                if labels:
+                    c = per.setdefault(labels[0], {})
+                    c[name] = c.get(name, 0) + v
+
+        def mean(e: dict, name: str) -> float:
+            (count, total) = e.get(name, (0, 0.0))
+            return total / count if count else 0.0
+
+        for (exchange, e) in sorted(per.items(), key=lambda i: -i[1].get('snap', (0, 0.0))[1]):
+            logging.info('metrics {} snaps={} snap={:.2f}s fetch={:.2f}s write={:.3f}s commit={:.3f}s requests={} '
+                         'trades/request={:.1f} retries={} errors={}'.format(
+                             exchange, e.get('snap', (0, 0.0))[0], mean(e, 'snap'), mean(e, 'trade_fetch'),
+                             mean(e, 'trade_write'), mean(e, 'trade_commit'), e.get('requests', 0),
+                             e.get('trades', 0) / max(e.get('requests', 0), 1), e.get('retries', 0),
+                             e.get('errors', 0)))
+
+    def serve(self, port: int, host: str = METRICS_HOST):
+        """Serves render() at /metrics from a daemon thread."""
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logging.info('metrics on http://{}:{}/metrics'.format(host, port))
+
+
+metrics = Metrics()
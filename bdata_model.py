@@ -1,8 +1,8 @@
 import datetime
 
 from sqlalchemy import Column, String, BigInteger, DateTime, Integer, ForeignKey, UniqueConstraint, Index, Numeric, \
-    Boolean, text
-from sqlalchemy.dialects.postgresql import JSONB
+    Boolean, Float, text
+from sqlalchemy.dialects.postgresql import JSONB, ARRAY
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
@@ -29,6 +29,9 @@ class ExchangeMarket(Base):
     base_token_id = Column(Integer, ForeignKey('token.token_id'))
     quote_token_id = Column(Integer, ForeignKey('token.token_id'))
     trade_ts = Column(BigInteger)
+    # fetch cursor: eid of the last stored trade and the exchange native token following it
+    trade_eid = Column(String)
+    trade_token = Column(String)
     base_token = relationship("Token", foreign_keys=[base_token_id], lazy="joined")
     quote_token = relationship("Token", foreign_keys=[quote_token_id], lazy="joined")
     disabled = Column(Boolean)
@@ -48,7 +51,9 @@ class BookSnap(Base):
     stat = Column(Boolean)
     asks = relationship('BookSnapAsk', backref='book_snap')
     bids = relationship('BookSnapBid', backref='book_snap')
-    __table_args__ = (Index('ix_book_snap_1', 'ts', 'exchange_market_id'),)
+    sides = relationship('BookSnapSide', backref='book_snap')
+    __table_args__ = (Index('ix_book_snap_1', 'ts', 'exchange_market_id'),
+                      Index('ix_book_snap_2', 'exchange_market_id', postgresql_where=text('not stat')))
 
 
 class BookSnapStat(Base):
@@ -58,6 +63,9 @@ class BookSnapStat(Base):
     # code - 0.01, 0.02, 0.03, 0.05, 0.08, 0.1, 0.2, 0.3, 0.5, 0.8, 1, 2, 3, 5, 8, 10, 20, 30, 50, 80, 100
     code = Column(String(10), nullable=False)
     data = Column(JSONB)
+    # layout of data: sql - bookSnapStat() result, numpy - bdata_stat.book_depth() {mid, bid, ask: {n, amount, total}},
+    # stream - book_depth() of a streamed partial book
+    layout = Column(String(10), nullable=False, server_default='sql')
     __table_args__ = (Index('ix_book_snap_stat_book_snap_id_code', 'book_snap_id', 'code', unique=True),)
 
 
@@ -79,11 +87,21 @@ class BookSnapBid(Base):
     __table_args__ = (Index('ix_book_snap_bid_1', 'book_snap_id'),)
 
 
+class BookSnapSide(Base):
+    __tablename__ = 'book_snap_side'
+    book_snap_id = Column(BigInteger, ForeignKey('book_snap.book_snap_id', ondelete='cascade'), primary_key=True)
+    # B - bids, A - asks, levels in exchange order
+    side = Column(String(1), primary_key=True)
+    price = Column(ARRAY(Numeric), nullable=False)
+    amount = Column(ARRAY(Numeric), nullable=False)
+
+
 class Trade(Base):
     __tablename__ = 'trade'
     trade_id = Column(BigInteger, primary_key=True, autoincrement=True)
     exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), nullable=False)
-    ts = Column(BigInteger, nullable=False)
+    # partition key, monthly range partitions managed by bdata_partition
+    ts = Column(BigInteger, primary_key=True, nullable=False)
     side = Column(String(1), nullable=False)
     price = Column(Numeric, nullable=False)
     amount = Column(Numeric, nullable=False)
@@ -91,7 +109,10 @@ class Trade(Base):
     eid = Column(String(32), nullable=True)
     __table_args__ = (Index('ix_trade_ts_exchange_market_id', 'ts', 'exchange_market_id'),
                       Index('ix_trade_exchange_market_id_ts', 'exchange_market_id', 'ts'),
-                      Index('ix_trade_exchange_market_id_dts', text('exchange_market_id, to_timestamp(ts / 1000.0)'))
+                      Index('ix_trade_exchange_market_id_trade_id', 'exchange_market_id', 'trade_id'),
+                      Index('ix_trade_exchange_market_id_dts', text('exchange_market_id, to_timestamp(ts / 1000.0)')),
+                      Index('ix_trade_exchange_market_id_eid', 'exchange_market_id', 'eid', 'ts', unique=True),
+                      {'postgresql_partition_by': 'RANGE (ts)'}
                       )
 
 
@@ -117,3 +138,75 @@ class Trade1M(Base):
     __table_args__ = (Index('ix_trade1m_exchange_market_id_dt', 'exchange_market_id', 'dt', unique=True),
                       Index('ix_trade1m_dt_exchange_market_id', 'dt', 'exchange_market_id', unique=True)
                       )
+
+
+class TradeBar:
+    """OHLCV columns of trade1m shared by the rollup tables."""
+    o = Column(Numeric)
+    h = Column(Numeric)
+    l = Column(Numeric)
+    c = Column(Numeric)
+    s = Column(Numeric)
+    sb = Column(Numeric)
+    ss = Column(Numeric)
+    z = Column(Numeric)
+    zb = Column(Numeric)
+    zs = Column(Numeric)
+    n = Column(Integer)
+    nb = Column(Integer)
+    ns = Column(Integer)
+    d = Column(Numeric)
+
+
+class Trade5M(TradeBar, Base):
+    __tablename__ = 'trade5m'
+    exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), primary_key=True)
+    dt = Column(DateTime, primary_key=True)
+
+
+class Trade15M(TradeBar, Base):
+    __tablename__ = 'trade15m'
+    exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), primary_key=True)
+    dt = Column(DateTime, primary_key=True)
+
+
+class Trade1H(TradeBar, Base):
+    __tablename__ = 'trade1h'
+    exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), primary_key=True)
+    dt = Column(DateTime, primary_key=True)
+
+
+class Trade1D(TradeBar, Base):
+    __tablename__ = 'trade1d'
+    exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), primary_key=True)
+    dt = Column(DateTime, primary_key=True)
+
+
+class TradeRollupMark(Base):
+    __tablename__ = 'trade_rollup_mark'
+    exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), primary_key=True)
+    # 5m, 15m, 1h, 1d
+    resolution = Column(String(10), primary_key=True)
+    # start of the first bar not rolled up yet
+    dt = Column(DateTime, nullable=False)
+
+
+class RateBudget(Base):
+    __tablename__ = 'rate_budget'
+    exchange = Column(String(50), primary_key=True)
+    # theoretical arrival time of the next request, epoch seconds
+    tat = Column(Float, nullable=False)
+
+
+# trade1m and rollup work of one market, leased by bdata_stat workers
+class StatJob(Base):
+    __tablename__ = 'stat_job'
+    exchange_market_id = Column(Integer, ForeignKey('exchange_market.exchange_market_id'), primary_key=True)
+    # exchange_market.trade_ts the bars are built up to
+    mark = Column(BigInteger)
+    # leased until, or held back until after a failure
+    lease_until = Column(DateTime)
+    owner = Column(String(100))
+    # consecutive failed leases
+    attempts = Column(Integer, nullable=False, default=0)
+    error = Column(String(1000))
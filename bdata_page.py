@@ -0,0 +1,132 @@
+from typing import Optional
+
+import ccxt
+
+TRADES_LIMIT = 100000
+# trades one poll is assumed to reach on exchanges that ignore since
+SHALLOW_DEPTH = 100
+
+HOUR_MS = 3600 * 1000
+MINUTE_MS = 60 * 1000
+
+
+class PageStrategy:
+    """Trade pagination of one exchange without I/O.
+
+    pages() yields fetch_trades kwargs, expects each page sent back and returns all trades.
+    """
+
+    def __init__(self, limit: Optional[int] = None, deep: bool = False):
+        # max page size accepted by the exchange, None leaves the exchange default
+        self.limit = limit
+        # the exchange honours since, so pages reach back to the cursor
+        self.deep = deep
+
+    @property
+    def depth(self) -> int:
+        """Trades one poll can fetch without leaving a gap."""
+        return TRADES_LIMIT if self.deep else self.limit or SHALLOW_DEPTH
+
+    def token(self, eid: Optional[str]) -> Optional[str]:
+        """Exchange native cursor following trade eid, None where the exchange has none."""
+        return None
+
+    def request(self, market: str, **kwargs) -> dict:
+        if self.limit:
+            kwargs['limit'] = self.limit
+        return dict(symbol=market, **kwargs)
+
+    def pages(self, market: str, since: int, max_ts: int, last_eid: str, token: Optional[str]):
+        trades_all = []
+        while since < max_ts and len(trades_all) < TRADES_LIMIT:
+            trades_tmp = yield self.request(market, since=since)
+            if len(trades_tmp) == 0 or last_eid == trades_tmp[-1]['id']:
+                break
+            since = trades_tmp[-1]['timestamp']
+            last_eid = trades_tmp[-1]['id']
+            trades_all += trades_tmp
+        return trades_all
+
+
+class WindowPaging(PageStrategy):
+    """Pages by [since, since + window) time windows, the window is sized from the observed trade rate of the
+    market to fill about half a page.
+
+    An exchange returns the last limit trades of a window holding more, so a full page is never taken: its window
+    is halved, below min_window if needed, until the page is not full.
+    """
+
+    def __init__(self, limit: int, max_window: int = HOUR_MS, min_window: int = MINUTE_MS):
+        super().__init__(limit, deep=True)
+        self.max_window = max_window
+        self.min_window = min_window
+        # market -> trades per ms
+        self.rates = {}
+
+    def window(self, market: str) -> int:
+        rate = self.rates.get(market)
+        if not rate:
+            return self.max_window
+        return int(min(self.max_window, max(self.min_window, self.limit / 2 / rate)))
+
+    def windows(self, market: str, since: int, max_ts: int, until_first: bool = False):
+        trades_all = []
+        w = self.window(market)
+        while since < max_ts and len(trades_all) < TRADES_LIMIT:
+            trades_tmp = yield self.request(market, since=since, params={'endTime': since + w - 1})
+            if len(trades_tmp) >= self.limit:
+                if w <= 1:
+                    raise ccxt.ExchangeError('{} {} trades or more at {}'.format(market, self.limit, since))
+                w //= 2
+                continue
+            trades_all += trades_tmp
+            since += w
+            if trades_tmp:
+                self.rates[market] = len(trades_tmp) / w
+                if until_first:
+                    break
+            w = self.window(market) if trades_tmp else min(self.max_window, w * 2)
+        return trades_all
+
+    def pages(self, market: str, since: int, max_ts: int, last_eid: str, token: Optional[str]):
+        return (yield from self.windows(market, since, max_ts))
+
+
+class BinancePaging(WindowPaging):
+    """aggTrades by fromId; without a cursor the first trade after since is located by time windows."""
+
+    def token(self, eid: Optional[str]) -> Optional[str]:
+        # fromId is inclusive
+        return str(int(eid) + 1) if eid and eid.isdigit() else None
+
+    def pages(self, market: str, since: int, max_ts: int, last_eid: str, token: Optional[str]):
+        trades_all = []
+        if not token:
+            trades_all = yield from self.windows(market, since, max_ts, until_first=True)
+            if not trades_all:
+                return trades_all
+            token = self.token(trades_all[-1]['id'])
+        while len(trades_all) < TRADES_LIMIT:
+            trades_tmp = yield self.request(market, params={'fromId': token})
+            trades_all += trades_tmp
+            if len(trades_tmp) < self.limit:
+                break
+            token = self.token(trades_tmp[-1]['id'])
+        return trades_all
+
+
+DEFAULT_PAGING = PageStrategy()
+
+# keyed by ccxt exchange id, exchanges not listed page by since with their default page size
+PAGE_STRATEGIES = {
+    'binance': BinancePaging(1000),
+    'binanceus': BinancePaging(1000),
+    'binanceusdm': BinancePaging(1000),
+    'binancecoinm': BinancePaging(1000),
+    'hitbtc': PageStrategy(1000, deep=True),
+    'poloniex': PageStrategy(1000, deep=True),
+}
+
+
+def page_strategy(exchange_id: str) -> PageStrategy:
+    return PAGE_STRATEGIES.get(exchange_id, DEFAULT_PAGING)
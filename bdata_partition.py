@@ -0,0 +1,81 @@
+import logging
+from datetime import datetime, timezone
+from typing import List, Tuple
+
+from sqlalchemy import text
+
+from bdata_db import engine
+
+PARTITIONS_AHEAD = 3
+ARCHIVE_SCHEMA = 'archive'
+# catches trades outside every monthly partition so an insert never fails for a missing month
+DEFAULT_PARTITION = 'trade_default'
+
+
+def add_months(year: int, month: int, n: int) -> Tuple[int, int]:
+    m = year * 12 + month - 1 + n
+    return m // 12, m % 12 + 1
+
+
+def month_ms(year: int, month: int) -> int:
+    return int(datetime(year, month, 1, tzinfo=timezone.utc).timestamp() * 1000)
+
+
+def partition_name(year: int, month: int) -> str:
+    return 'trade_p{:04d}{:02d}'.format(year, month)
+
+
+def trade_partitions(connection) -> List[Tuple[str, int, int]]:
+    rows = connection.execute(text("""
+        select c.relname
+        from pg_inherits i
+            join pg_class c on c.oid = i.inhrelid
+        where i.inhparent = 'trade'::regclass and c.relname like 'trade\\_p%'
+        order by c.relname""")).fetchall()
+    return [(r[0], int(r[0][7:11]), int(r[0][11:13])) for r in rows]
+
+
+def create_trade_partition(connection, year: int, month: int):
+    """Creates the partition of a month unless it exists, moving the month's rows out of the default partition; a
+    partition can't be added while the default one holds rows of its range."""
+    name = partition_name(year, month)
+    if connection.execute(text('select to_regclass(:name)'), {'name': name}).scalar():
+        return
+    (ny, nm) = add_months(year, month, 1)
+    (lo, hi) = (month_ms(year, month), month_ms(ny, nm))
+    connection.execute(text('create table {} (like trade including defaults including constraints)'.format(name)))
+    moved = connection.execute(text(
+        'with d as (delete from {} where ts >= :lo and ts < :hi returning *) insert into {} select * from d'.
+        format(DEFAULT_PARTITION, name)), {'lo': lo, 'hi': hi}).rowcount
+    if moved:
+        logging.info('moved {} trades from {} to {}'.format(moved, DEFAULT_PARTITION, name))
+    connection.execute(text('alter table trade attach partition {} for values from ({}) to ({})'.format(name, lo, hi)))
+
+
+def ensure_trade_partitions(ahead: int = PARTITIONS_AHEAD):
+    """Creates the default trade partition and monthly ones from the current month up to ahead months in advance."""
+    now = datetime.utcnow()
+    with engine.begin() as connection:
+        connection.execute(text('create table if not exists {} partition of trade default'.format(DEFAULT_PARTITION)))
+        for i in range(0, ahead + 1):
+            (y, m) = add_months(now.year, now.month, i)
+            create_trade_partition(connection, y, m)
+
+
+def detach_trade_partitions(keep: int):
+    """Detaches partitions older than keep months and moves them to the archive schema."""
+    now = datetime.utcnow()
+    (ky, km) = add_months(now.year, now.month, -keep)
+    with engine.begin() as connection:
+        connection.execute(text('create schema if not exists {}'.format(ARCHIVE_SCHEMA)))
+        for (name, y, m) in trade_partitions(connection):
+            if (y, m) < (ky, km):
+                logging.info('detach trade partition {}'.format(name))
+                connection.execute(text('alter table trade detach partition {}'.format(name)))
+                connection.execute(text('alter table {} set schema {}'.format(name, ARCHIVE_SCHEMA)))
+
+
+def maintain_trade_partitions(keep: int = 0, ahead: int = PARTITIONS_AHEAD):
+    ensure_trade_partitions(ahead)
+    if keep > 0:
+        detach_trade_partitions(keep)
@@ -0,0 +1,81 @@
+import random
+import threading
+from enum import Enum
+from typing import Optional, Tuple
+
+import ccxt
+
+RETRIES = 3
+# consecutive snaps failing with a permanent error before a market is disabled
+DISABLE_AFTER = 3
+
+
+class ErrorClass(Enum):
+    TRANSIENT = "transient"
+    RATE_LIMIT = "rate_limit"
+    PERMANENT = "permanent"
+
+
+# errors retrying will not fix, BadSymbol is a BadRequest
+PERMANENT_ERRORS = (ccxt.BadRequest, ccxt.NotSupported, ccxt.AuthenticationError, ccxt.PermissionDenied,
+                    ccxt.AccountSuspended)
+
+
+class PartialFailure(Exception):
+    """Some parts of a job failed: error is what the retry backs off on, retry_kwargs narrow the retried call to
+    the parts worth retrying."""
+
+    def __init__(self, error: BaseException, retry_kwargs: dict):
+        super().__init__(str(error))
+        self.error = error
+        self.retry_kwargs = retry_kwargs
+
+
+def classify(e: BaseException) -> ErrorClass:
+    if isinstance(e, PartialFailure):
+        return classify(e.error)
+    # DDoSProtection (RateLimitExceeded included) is a NetworkError, test it first
+    if isinstance(e, ccxt.DDoSProtection):
+        return ErrorClass.RATE_LIMIT
+    if isinstance(e, PERMANENT_ERRORS):
+        return ErrorClass.PERMANENT
+    return ErrorClass.TRANSIENT
+
+
+class RetryPolicy:
+    """Jittered exponential backoff by error class and per market count of consecutive permanent failures."""
+
+    def __init__(self, retries: int = RETRIES, base: float = 2.0, rate_limit_base: float = 15.0, cap: float = 120.0,
+                 disable_after: int = DISABLE_AFTER):
+        self.retries = retries
+        self.base = base
+        self.rate_limit_base = rate_limit_base
+        self.cap = cap
+        self.disable_after = disable_after
+        self.lock = threading.Lock()
+        # (exchange id, symbol, part) -> consecutive permanent failures
+        self.failures = {}
+        # parts turned off for this process after disable_after permanent failures
+        self.disabled = set()
+
+    def delay(self, error_class: ErrorClass, attempt: int) -> Optional[float]:
+        """Seconds before retry number attempt + 1, None when the snap should not be retried."""
+        if error_class == ErrorClass.PERMANENT or attempt + 1 >= self.retries:
+            return None
+        base = self.rate_limit_base if error_class == ErrorClass.RATE_LIMIT else self.base
+        d = min(self.cap, base * 2 ** attempt)
+        return random.uniform(d / 2, d)
+
+    def success(self, key: Tuple[str, ...]):
+        if key in self.failures:
+            with self.lock:
+                self.failures.pop(key, None)
+
+    def failure(self, key: Tuple[str, ...], error_class: ErrorClass) -> bool:
+        """Records a failed snap part, True when it should be disabled."""
+        with self.lock:
+            if error_class != ErrorClass.PERMANENT:
+                self.failures.pop(key, None)
+                return False
+            n = self.failures[key] = self.failures.get(key, 0) + 1
+        return n >= self.disable_after
@@ -0,0 +1,326 @@
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+import ccxt
+from sqlalchemy import text
+
+from bdata_db import engine
+from bdata_metrics import metrics
+from bdata_retry import RetryPolicy, classify
+
+
+class GateStats:
+    """Request counters of a rate gate: throttled counts requests that had to wait for their slot."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.wait = 0.0
+        self.max_wait = 0.0
+        self.errors = 0
+        self.penalties = 0
+
+    def record(self, wait: float):
+        with self.lock:
+            self.requests += 1
+            if wait > 0:
+                self.throttled += 1
+                self.wait += wait
+                self.max_wait = max(self.max_wait, wait)
+
+    def log(self, exchange_id: str):
+        logging.info('rate {} requests={} throttled={} wait={:.1f}s max_wait={:.2f}s penalties={} errors={}'.format(
+            exchange_id, self.requests, self.throttled, self.wait, self.max_wait, self.penalties, self.errors))
+
+
+class RateGate:
+    """Thread safe replacement for ccxt's throttle(), reserves one request slot per rateLimit ms."""
+
+    def __init__(self, interval_ms: float):
+        self.interval = interval_ms / 1000.0
+        self.lock = threading.Lock()
+        self.next_ts = 0.0
+        self.stats = GateStats()
+
+    def reserve(self) -> float:
+        """Takes the next request slot, returns seconds to wait for it."""
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_ts)
+            self.next_ts = slot + self.interval
+        return slot - now
+
+    def penalize(self, seconds: float):
+        """Holds every request of the exchange for seconds, after the exchange reported a rate limit hit."""
+        with self.lock:
+            self.next_ts = max(self.next_ts, time.monotonic() + seconds)
+        with self.stats.lock:
+            self.stats.penalties += 1
+
+    def __call__(self, *args):
+        wait = self.reserve()
+        self.stats.record(wait)
+        if wait > 0:
+            time.sleep(wait)
+
+
+# one upsert reserves the next n slots of an exchange for every process sharing the database (GCRA), returns the
+# seconds until the first of them
+RESERVE_SQL = text("""
+    insert into rate_budget as b (exchange, tat)
+    values (:exchange, extract(epoch from clock_timestamp()) + :interval * :n)
+    on conflict (exchange) do update
+        set tat = greatest(b.tat, extract(epoch from clock_timestamp())) + :interval * :n
+    returning b.tat - :interval * :n - extract(epoch from clock_timestamp())""")
+
+
+# seconds on the local gates after a rate_budget error
+SHARED_GATE_RETRY = 30
+# most slots one rate_budget round trip reserves for a busy exchange
+SHARED_GATE_BATCH = 8
+
+
+class RateBudgetConnection:
+    """The one rate_budget connection of a process, shared by all its SharedRateGates."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connection = None
+        self.retry_ts = 0.0
+
+    def reserve(self, exchange_id: str, interval: float, n: int) -> Optional[float]:
+        """Reserves n consecutive slots, returns seconds until the first one, None while the database is
+        unreachable; raises when it just became unreachable."""
+        with self.lock:
+            if time.monotonic() < self.retry_ts:
+                return None
+            try:
+                if self.connection is None:
+                    self.connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+                return self.connection.execute(RESERVE_SQL, {'exchange': exchange_id, 'interval': interval,
+                                                             'n': n}).scalar()
+            except Exception:
+                self.retry_ts = time.monotonic() + SHARED_GATE_RETRY
+                if self.connection is not None:
+                    self.connection.invalidate()
+                    self.connection = None
+                raise
+
+
+rate_budget = RateBudgetConnection()
+
+
+class SharedRateGate(RateGate):
+    """RateGate whose slots are reserved in the rate_budget table, so all bdata processes using the same database
+    share one budget per exchange. Slots are reserved in batches, doubling up to SHARED_GATE_BATCH while the
+    exchange keeps using them and back to one once a batch goes stale. Falls back to the local gate while the
+    database is unreachable."""
+
+    def __init__(self, exchange_id: str, interval_ms: float):
+        super().__init__(interval_ms)
+        self.exchange_id = exchange_id
+        # reserved slots left, the next one at next_ts
+        self.slots = 0
+        self.batch = 1
+        self.hold_ts = 0.0
+
+    def penalize(self, seconds: float):
+        self.hold_ts = max(self.hold_ts, time.monotonic() + seconds)
+        super().penalize(seconds)
+
+    def reserve(self) -> float:
+        with self.lock:
+            now = time.monotonic()
+            if self.next_ts < now:
+                # idle: what is left of the batch is past
+                (self.slots, self.batch) = (0, 1)
+            elif self.slots == 0:
+                # busy: the batch ran out before its slots passed
+                self.batch = min(SHARED_GATE_BATCH, self.batch * 2)
+            if self.slots == 0:
+                try:
+                    wait = rate_budget.reserve(self.exchange_id, self.interval, self.batch)
+                except Exception as e:
+                    logging.error('{} rate budget error {}'.format(self.exchange_id, str(e)))
+                    self.stats.errors += 1
+                    wait = None
+                if wait is not None:
+                    self.next_ts = max(self.next_ts, now + wait)
+                    self.slots = self.batch
+            self.slots = max(0, self.slots - 1)
+            slot = max(now, self.next_ts)
+            self.next_ts = slot + self.interval
+            return max(slot, self.hold_ts) - now
+
+
+def rate_gate(exchange: ccxt.Exchange, shared: bool = False) -> RateGate:
+    return SharedRateGate(exchange.id, exchange.rateLimit) if shared else RateGate(exchange.rateLimit)
+
+
+def install_rate_gate(exchange: ccxt.Exchange, shared: bool = False):
+    exchange.throttle = rate_gate(exchange, shared)
+
+
+class AdaptivePoll:
+    """Per market trade poll times from the observed trade arrival rate.
+
+    The interval is what it takes to accumulate POLL_FILL of the trades one poll can paginate through (depth),
+    kept within [min_interval, max_interval] seconds.
+    """
+    POLL_FILL = 0.5
+    # weight of the newest rate sample
+    ALPHA = 0.5
+
+    def __init__(self, min_interval: float, max_interval: float):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        # (exchange id, symbol) -> [trades per second, last poll, next poll], time.time() based
+        self.markets = {}
+
+    def due(self, key: Tuple[str, str]) -> bool:
+        m = self.markets.get(key)
+        return m is None or time.time() >= m[2]
+
+    def update(self, key: Tuple[str, str], n: int, depth: int):
+        now = time.time()
+        m = self.markets.get(key)
+        if m is None:
+            m = self.markets[key] = [None, now, now + self.min_interval]
+            return
+        sample = n / max(now - m[1], 1.0)
+        m[0] = sample if m[0] is None else self.ALPHA * sample + (1 - self.ALPHA) * m[0]
+        interval = depth * self.POLL_FILL / m[0] if m[0] > 0 else self.max_interval
+        m[1] = now
+        m[2] = now + min(self.max_interval, max(self.min_interval, interval))
+
+
+class Cycle:
+    def __init__(self, ts: datetime, deadline: datetime, total: int):
+        self.ts = ts
+        self.deadline = deadline
+        self.pending = total
+        self.done = 0
+        self.skipped = 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        if total == 0:
+            self.log_end()
+
+    def finish(self, skipped: bool = False):
+        with self.lock:
+            if skipped:
+                self.skipped += 1
+            else:
+                self.done += 1
+            self.pending -= 1
+            last = self.pending == 0
+        if last:
+            self.log_end()
+
+    def log_end(self):
+        metrics.set('cycle_lag_seconds', (datetime.now() - self.ts).total_seconds())
+        metrics.set('cycle_elapsed_seconds', time.monotonic() - self.started)
+        metrics.set('cycle_done', self.done)
+        metrics.set('cycle_skipped', self.skipped)
+        logging.info('end snap ts={} done={} skipped={} elapsed={:.1f}s'.format(
+            self.ts, self.done, self.skipped, time.monotonic() - self.started))
+
+
+class ExchangeQueue:
+    def __init__(self):
+        self.jobs = deque()
+        self.lanes = 0
+
+
+class MarketScheduler:
+    """Runs snaps on a shared pool: exchanges in parallel, at most exchange_workers lanes per exchange. A lane runs
+    one snap per turn and queues its next turn behind the lanes of the other exchanges, so the pool serves the
+    exchanges round-robin and a busy exchange cannot starve the rest.
+
+    Scheduling a cycle never blocks; jobs still queued when their cycle deadline passes are skipped and a
+    market whose previous snap is still running is not started twice. A failed snap is queued again after the
+    retry policy backoff, its lane moves on to other markets meanwhile; a PartialFailure narrows the retried call
+    with its retry_kwargs.
+    """
+
+    def __init__(self, workers: int, exchange_workers: int, fn: Callable[[ccxt.Exchange, dict, datetime], None],
+                 retry: Optional[RetryPolicy] = None):
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.exchange_workers = max(1, min(exchange_workers, workers))
+        self.fn = fn
+        self.retry = retry or RetryPolicy()
+        self.lock = threading.Lock()
+        self.queues = {}
+        self.running = set()
+
+    def schedule(self, jobs: List[Tuple[ccxt.Exchange, List[dict]]], ts: datetime, deadline: datetime) -> Cycle:
+        cycle = Cycle(ts, deadline, sum(len(markets) for _, markets in jobs))
+        stale = []
+        with self.lock:
+            for exchange, markets in jobs:
+                q = self.queues.setdefault(exchange.id, ExchangeQueue())
+                stale += q.jobs
+                q.jobs.clear()
+                q.jobs.extend((exchange, market, cycle, 0, {}) for market in markets)
+                self.start_lanes(q)
+        for (exchange, market, c, attempt, kwargs) in stale:
+            metrics.inc('skipped', labels=(exchange.id, market['symbol']))
+            logging.warning('{}::{} skipped, cycle ts={} overrun'.format(exchange.id, market['symbol'], c.ts))
+            c.finish(skipped=True)
+        return cycle
+
+    def start_lanes(self, q: ExchangeQueue):
+        for i in range(min(self.exchange_workers, len(q.jobs)) - q.lanes):
+            q.lanes += 1
+            self.pool.submit(self.lane, q)
+
+    def requeue(self, q: ExchangeQueue, job: tuple):
+        with self.lock:
+            q.jobs.append(job)
+            self.start_lanes(q)
+
+    def lane(self, q: ExchangeQueue):
+        """One snap of q, skipped jobs do not use up the turn."""
+        while True:
+            with self.lock:
+                if not q.jobs:
+                    q.lanes -= 1
+                    return
+                exchange, market, cycle, attempt, kwargs = q.jobs.popleft()
+                key = (exchange.id, market['symbol'])
+                skip = key in self.running or datetime.now() >= cycle.deadline
+                if not skip:
+                    self.running.add(key)
+            if skip:
+                metrics.inc('skipped', labels=key)
+                cycle.finish(skipped=True)
+                continue
+            delay = None
+            try:
+                self.fn(exchange, market, cycle.ts, **kwargs)
+            except Exception as e:
+                delay = self.retry.delay(classify(e), attempt)
+                kwargs = getattr(e, 'retry_kwargs', kwargs)
+            finally:
+                with self.lock:
+                    self.running.discard(key)
+            if delay is not None and datetime.now() + timedelta(seconds=delay) < cycle.deadline:
+                metrics.inc('retries', labels=key)
+                timer = threading.Timer(delay, self.requeue, (q, (exchange, market, cycle, attempt + 1, kwargs)))
+                timer.daemon = True
+                timer.start()
+            else:
+                cycle.finish()
+            with self.lock:
+                if not q.jobs:
+                    q.lanes -= 1
+                    return
+                # next turn behind the lanes already waiting for the pool
+                self.pool.submit(self.lane, q)
+                return
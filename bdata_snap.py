@@ -0,0 +1,428 @@
+import datetime
+import json
+import logging
+import os
+import time
+from argparse import Namespace
+from decimal import Decimal
+from enum import Enum
+from typing import Tuple, Optional
+
+import ccxt
+from sqlalchemy import and_
+
+from bdata_cache import market_cache, ExchangeRef, ExchangeMarketRef, TokenRef
+from bdata_db import Session, copy_rows, notify, BOOK_CHANNEL, TRADE_CHANNEL
+from bdata_metrics import metrics
+from bdata_model import ExchangeMarket, BookSnap, BookSnapBid, BookSnapAsk, BookSnapSide, BookSnapStat, Trade
+from bdata_page import page_strategy
+from bdata_retry import RetryPolicy, ErrorClass, PartialFailure, classify
+from bdata_sched import AdaptivePoll, install_rate_gate
+from bdata_stat import book_stat, BookEngine, STREAM_LAYOUT
+
+KUCOIN = 'kucoin'
+BINANCE = 'binance'
+COINBASEPRO = 'coinbasepro'
+
+DEFAULT_BOOK_LIMIT = None
+
+
+class SnapTarget(Enum):
+    ALL = "all"
+    BOOK = "book"
+    TRADE = "trade"
+    # exchange WebSocket feeds where available, REST snaps of both for the rest and while a feed is down
+    STREAM = "stream"
+
+
+class BookStorage(Enum):
+    ROWS = "rows"
+    ARRAY = "array"
+    # depth stats computed at capture time, levels are not stored
+    STAT = "stat"
+
+
+class RateScope(Enum):
+    # rateLimit enforced per process, off in proxy mode
+    LOCAL = "local"
+    # one budget per exchange shared through the rate_budget table by every process, proxy mode included
+    SHARED = "shared"
+
+
+def decimalize(book):
+    return {'bids': [(Decimal(str(b[0])), Decimal(str(b[1]))) for b in book['bids']],
+            'asks': [(Decimal(str(a[0])), Decimal(str(a[1]))) for a in book['asks']]
+            }
+
+
+def book_limit(exchange: ccxt.Exchange):
+    if exchange.id == KUCOIN:
+        return 100
+    elif exchange.id == BINANCE:
+        return 5000
+    else:
+        return DEFAULT_BOOK_LIMIT
+
+
+def book_params(exchange: ccxt.Exchange):
+    if exchange.id == COINBASEPRO:
+        return {'level': 3}
+    else:
+        return {}
+
+
+def ensure_exchange_market(session, exchange, base, quote) \
+        -> Tuple[ExchangeRef, ExchangeMarketRef, TokenRef, TokenRef]:
+    return market_cache.ensure(session, exchange.id, base, quote)
+
+
+def book_exists(session, em: ExchangeMarketRef, mts: datetime.datetime) -> bool:
+    return session.query(BookSnap).filter(
+        and_(BookSnap.exchange_market_id == em.exchange_market_id, BookSnap.mts == mts)).first() is not None
+
+
+def store_book(session, em: ExchangeMarketRef, mts: datetime.datetime, bo: dict,
+               storage: BookStorage = BookStorage.ROWS):
+    bs = BookSnap(exchange_market_id=em.exchange_market_id, mts=mts)
+    session.add(bs)
+    b = decimalize(bo)
+    if storage == BookStorage.STAT:
+        add_book_stat(session, bs, b, BookEngine.NUMPY.value)
+        session.commit()
+        return
+    if storage == BookStorage.ARRAY:
+        bs.sides.append(BookSnapSide(side='B', price=[p for (p, a) in b['bids']], amount=[a for (p, a) in b['bids']]))
+        bs.sides.append(BookSnapSide(side='A', price=[p for (p, a) in b['asks']], amount=[a for (p, a) in b['asks']]))
+    else:
+        for (p, a) in b['bids']:
+            bs.bids.append(BookSnapBid(price=p, amount=a))
+        for (p, a) in b['asks']:
+            bs.asks.append(BookSnapAsk(price=p, amount=a))
+    session.commit()
+
+    bs.stat = False
+    session.add(bs)
+    notify(session, BOOK_CHANNEL, str(em.exchange_market_id))
+    session.commit()
+
+
+def add_book_stat(session, bs: BookSnap, b: dict, layout: str):
+    bs.stat = True
+    session.flush()
+    for (code, data) in book_stat(b['bids'], b['asks']).items():
+        session.add(BookSnapStat(book_snap_id=bs.book_snap_id, code=code, data=data, layout=layout))
+
+
+def store_stream_book(session, em: ExchangeMarketRef, mts: datetime.datetime, bo: dict):
+    """Stores the stats of a streamed partial book under their own layout, apart from those of the full REST books."""
+    bs = BookSnap(exchange_market_id=em.exchange_market_id, mts=mts)
+    session.add(bs)
+    add_book_stat(session, bs, decimalize(bo), STREAM_LAYOUT)
+    session.commit()
+
+
+def snap_book(session, mts: datetime.datetime, exchange: ccxt.Exchange, base: str, quote: str,
+              storage: BookStorage = BookStorage.ROWS):
+    logging.info('{}::{} snap book'.format(exchange.id, base + '/' + quote))
+    (e, em, bt, qt) = ensure_exchange_market(session, exchange, base, quote)
+
+    if book_exists(session, em, mts):
+        return
+
+    with metrics.timer('book_fetch'):
+        metrics.inc('requests')
+        bo = exchange.fetch_order_book(bt.symbol + '/' + qt.symbol, limit=book_limit(exchange),
+                                       params=book_params(exchange))
+    with metrics.timer('book_write'):
+        store_book(session, em, mts, bo, storage)
+
+
+def trade_cursor(session, exchange: ccxt.Exchange, em: ExchangeMarketRef) -> Tuple[int, str, Optional[str]]:
+    """(since, last eid, native pagination token) of a market, read from the cached exchange_market cursor."""
+    if em.trade_ts is not None:
+        return em.trade_ts, em.trade_eid or '', em.trade_token
+
+    # no cursor yet, start from the last stored trade if any
+    last = session.query(Trade.ts, Trade.eid).filter(Trade.exchange_market_id == em.exchange_market_id). \
+        order_by(Trade.ts.desc(), Trade.trade_id.desc()).first()
+    if last:
+        return last.ts, last.eid or '', trade_token(exchange.id, last.eid)
+    return exchange.milliseconds() - exchange.milliseconds() % 86400000, '', None
+
+
+def trade_token(exchange_id: str, eid: Optional[str]) -> Optional[str]:
+    return page_strategy(exchange_id).token(eid)
+
+
+def page_trades(exchange_id: str, market: str, since: int, max_ts: int, last_eid: str, token: Optional[str] = None):
+    """Trade pagination without I/O: yields fetch_trades kwargs, expects each page sent back, returns all trades."""
+    return (yield from page_strategy(exchange_id).pages(market, since, max_ts, last_eid, token))
+
+
+def fetch_trades(exchange: ccxt.Exchange, market: str, since: int, last_eid: str, token: Optional[str] = None) -> list:
+    pager = page_trades(exchange.id, market, since, exchange.milliseconds(), last_eid, token)
+    with metrics.timer('trade_fetch'):
+        try:
+            request = next(pager)
+            while True:
+                metrics.inc('requests')
+                request = pager.send(exchange.fetch_trades(**request))
+        except StopIteration as stop:
+            metrics.inc('trades', len(stop.value))
+            return stop.value
+
+
+TRADE_COLUMNS = ['exchange_market_id', 'ts', 'side', 'price', 'amount', 'eid']
+
+
+def add_trades_orm(session, em: ExchangeMarketRef, trades: list):
+    for e in trades:
+        session.add(
+            Trade(exchange_market_id=em.exchange_market_id,
+                  ts=e['timestamp'],
+                  side='B' if e['side'] == 'buy' else 'S',
+                  price=Decimal(str(e['price'])) if e['price'] else 0,
+                  amount=Decimal(str(e['amount'])) if e['amount'] else 0,
+                  eid=e['id']))
+
+
+def add_trades_bulk(session, em: ExchangeMarketRef, trades: list) -> int:
+    return copy_rows(session, Trade.__table__, TRADE_COLUMNS,
+                     [(em.exchange_market_id,
+                       e['timestamp'],
+                       'B' if e['side'] == 'buy' else 'S',
+                       str(e['price']) if e['price'] else '0',
+                       str(e['amount']) if e['amount'] else '0',
+                       e['id']) for e in trades], ignore_conflicts=True)
+
+
+def store_trades(session, exchange: ccxt.Exchange, em: ExchangeMarketRef, market: str, trades_all: list):
+    # duplicates are dropped by ix_trade_exchange_market_id_eid
+    n = 0
+    if len(trades_all) > 0:
+        with metrics.timer('trade_write'):
+            n = add_trades_bulk(session, em, trades_all)
+        metrics.inc('duplicates', len(trades_all) - n)
+        last = trades_all[-1]
+        cursor = {'trade_ts': last['timestamp'], 'trade_eid': last['id'],
+                  'trade_token': trade_token(exchange.id, last['id'])}
+        session.query(ExchangeMarket).filter(ExchangeMarket.exchange_market_id == em.exchange_market_id). \
+            update(cursor, synchronize_session=False)
+        notify(session, TRADE_CHANNEL, str(em.exchange_market_id))
+    logging.info('{}::{} len={}'.format(exchange.id, market, n))
+
+    with metrics.timer('trade_commit'):
+        session.commit()
+    if len(trades_all) > 0:
+        (em.trade_ts, em.trade_eid, em.trade_token) = (cursor['trade_ts'], cursor['trade_eid'], cursor['trade_token'])
+
+
+def snap_trades(session, ts: datetime.datetime, exchange: ccxt.Exchange, base: str, quote: str) -> int:
+    logging.info('{}::{} snap trades'.format(exchange.id, base + '/' + quote))
+    try:
+        (e, em, bt, qt) = ensure_exchange_market(session, exchange, base, quote)
+        (since, last_eid, token) = trade_cursor(session, exchange, em)
+        market = base + '/' + quote
+        trades_all = fetch_trades(exchange, market, since, last_eid, token)
+        store_trades(session, exchange, em, market, trades_all)
+        logging.info('{}::{} end'.format(exchange.id, market))
+        return len(trades_all)
+    except:
+        session.rollback()
+        raise
+
+
+def disable_market(session, em: ExchangeMarketRef):
+    session.query(ExchangeMarket).filter(ExchangeMarket.exchange_market_id == em.exchange_market_id). \
+        update({ExchangeMarket.disabled: True}, synchronize_session=False)
+    session.commit()
+    em.disabled = True
+
+
+def part_key(exchange: ccxt.Exchange, market: dict, part: SnapTarget) -> tuple:
+    return exchange.id, market['symbol'], part.value
+
+
+def snap_failed(session, exchange: ccxt.Exchange, market: dict, em: Optional[ExchangeMarketRef], e: Exception,
+                retry: RetryPolicy, part: SnapTarget = SnapTarget.ALL):
+    """Logs a failed snap part, backs the exchange off on rate limit errors. Repeated permanent errors of the
+    trade part disable the market, of the book part only turn books off for this process."""
+    key = part_key(exchange, market, part)
+    error_class = classify(e)
+    metrics.inc('errors')
+    logging.error('{}::{} {} {} {} {}'.format(exchange.id, market['symbol'], part.value, error_class.value,
+                                             type(e).__name__, e))
+    session.rollback()
+    if error_class == ErrorClass.RATE_LIMIT and hasattr(exchange.throttle, 'penalize'):
+        exchange.throttle.penalize(retry.rate_limit_base)
+    if not retry.failure(key, error_class):
+        return
+    if part == SnapTarget.BOOK:
+        logging.warning('{}::{} books disabled after {} permanent errors'.format(exchange.id, market['symbol'],
+                                                                                retry.disable_after))
+        retry.disabled.add(key)
+    elif em:
+        logging.warning('{}::{} disabled after {} permanent errors'.format(exchange.id, market['symbol'],
+                                                                          retry.disable_after))
+        disable_market(session, em)
+
+
+def snap_parts(exchange: ccxt.Exchange, market: dict, snap_target: SnapTarget, retry: RetryPolicy) -> list:
+    """The parts a snap of snap_target runs, without the parts turned off after permanent errors."""
+    parts = [SnapTarget.BOOK, SnapTarget.TRADE] if snap_target == SnapTarget.ALL else [snap_target]
+    return [p for p in parts if part_key(exchange, market, p) not in retry.disabled]
+
+
+def snap_error(failed: dict) -> Exception:
+    """The error a snap raises for its failed parts, its retry covers only the parts a retry can fix."""
+    retryable = {p: e for p, e in failed.items() if classify(e) != ErrorClass.PERMANENT}
+    if not retryable:
+        return next(iter(failed.values()))
+    # back off on a rate limit when any part hit one
+    error = max(retryable.values(), key=lambda e: classify(e) == ErrorClass.RATE_LIMIT)
+    target = next(iter(retryable)) if len(retryable) == 1 else SnapTarget.ALL
+    return PartialFailure(error, {'snap_target': target})
+
+
+def snap(exchange: ccxt.Exchange, market: dict, ts: datetime, snap_target: SnapTarget,
+         book_storage: BookStorage = BookStorage.ROWS, poll: Optional[AdaptivePoll] = None,
+         retry: Optional[RetryPolicy] = None):
+    """One snap attempt of a market. Book and trades are tried independently, the failed parts propagate so the
+    scheduler can retry them with backoff."""
+    retry = retry or RetryPolicy()
+    base = market['base']
+    quote = market['quote']
+    key = (exchange.id, market['symbol'])
+    failed = {}
+    with metrics.labels(*key), metrics.timer('snap'):
+        session = Session()
+        em = None
+        try:
+            (e, em, bt, qt) = ensure_exchange_market(session, exchange, base, quote)
+            if em.disabled:
+                return
+            for part in snap_parts(exchange, market, snap_target, retry):
+                if part == SnapTarget.TRADE and poll and not poll.due(key):
+                    continue
+                try:
+                    if part == SnapTarget.BOOK:
+                        snap_book(session, ts, exchange, base, quote, book_storage)
+                    else:
+                        n = snap_trades(session, ts, exchange, base, quote)
+                        if poll:
+                            poll.update(key, n, page_strategy(exchange.id).depth)
+                    retry.success(part_key(exchange, market, part))
+                except Exception as e:
+                    snap_failed(session, exchange, market, em, e, retry, part)
+                    failed[part] = e
+        except Exception as e:
+            snap_failed(session, exchange, market, em, e, retry)
+            raise
+        finally:
+            session.close()
+    if failed:
+        raise snap_error(failed)
+
+
+def stream_snap(exchange: ccxt.Exchange, market: dict, ts: datetime, collector,
+                snap_target: SnapTarget = SnapTarget.ALL, **kwargs):
+    """REST snap of a stream mode market: books always, trades only while the market is not live on its feed."""
+    if collector.live(exchange.id, market['symbol']):
+        if snap_target == SnapTarget.TRADE:
+            return
+        snap_target = SnapTarget.BOOK
+    snap(exchange, market, ts, snap_target, **kwargs)
+
+
+def make_poll(args: Namespace) -> Optional[AdaptivePoll]:
+    if args.max_poll == 0:
+        return None
+    return AdaptivePoll(args.min_poll or args.interval, args.max_poll)
+
+
+def exchange_filter(exchange) -> bool:
+    return exchange.has['publicAPI'] and exchange.has['fetchOrderBook'] and exchange.has['fetchTrades']
+
+
+def create_exchange(cls):
+    exchange = cls()
+    if exchange.id.startswith('bitfinex'):
+        exchange.rateLimit = 5000
+    return exchange
+
+
+STATS_LOG_INTERVAL = 600
+
+
+def log_stats(exchanges: list):
+    for exchange in exchanges:
+        stats = getattr(exchange.throttle, 'stats', None)
+        if stats:
+            stats.log(exchange.id)
+    metrics.log_summary()
+
+
+MARKETS_CACHE_DIR = os.path.join('cache', 'markets')
+MARKETS_CACHE_TTL = 6 * 3600
+
+# exchange id -> time.time() of the markets in use
+markets_ts: dict = {}
+
+
+def read_markets_cache(exchange_id: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(MARKETS_CACHE_DIR, exchange_id + '.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_markets_cache(exchange):
+    """Saves the loaded markets; a failed write only costs the cache, the exchange keeps its markets."""
+    markets_ts[exchange.id] = time.time()
+    try:
+        os.makedirs(MARKETS_CACHE_DIR, exist_ok=True)
+        path = os.path.join(MARKETS_CACHE_DIR, exchange.id + '.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'ts': time.time(), 'markets': exchange.markets, 'currencies': exchange.currencies}, f)
+        os.replace(path + '.tmp', path)
+    except Exception as e:
+        logging.error('{} markets cache write error {} {}'.format(exchange.id, type(e).__name__, e))
+
+
+def use_markets_cache(exchange) -> bool:
+    cached = read_markets_cache(exchange.id)
+    if not cached:
+        return False
+    exchange.set_markets(cached['markets'], cached['currencies'] or None)
+    markets_ts[exchange.id] = cached['ts']
+    return True
+
+
+def refresh_markets(exchange: ccxt.Exchange):
+    try:
+        exchange.load_markets(reload=True)
+        write_markets_cache(exchange)
+        logging.info('{} markets refreshed'.format(exchange.id))
+    except Exception as e:
+        logging.error('{} markets refresh error {}'.format(exchange.id, str(e)))
+
+
+def init_exchange(name: str, cfg: dict, shared: bool = False) -> Optional[ccxt.Exchange]:
+    exchange = create_exchange(getattr(ccxt, name))
+    if not exchange_filter(exchange):
+        return None
+    try:
+        if 'proxies' in cfg:
+            exchange.proxies = cfg['proxies']
+        exchange.enableRateLimit = 'proxies' not in cfg or shared
+        if exchange.enableRateLimit:
+            install_rate_gate(exchange, shared)
+        if not use_markets_cache(exchange):
+            exchange.load_markets()
+            write_markets_cache(exchange)
+        exchange.timeout = 60000
+        return exchange
+    except Exception as e:
+        logging.error('{} error {}'.format(exchange.id, str(e)))
+        return None
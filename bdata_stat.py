@@ -1,14 +1,50 @@
+import json
 import logging
+import os
+import select
+import socket
+import threading
 import time
-from concurrent.futures import ThreadPoolExecutor
+from argparse import ArgumentParser
 from datetime import datetime, timedelta
+from enum import Enum
+from functools import partial
+from typing import Callable, List, Optional, Tuple
 
+import numpy as np
 from sqlalchemy import text
 
-from bdata_db import engine
+from bdata_db import engine, BOOK_CHANNEL, TRADE_CHANNEL
+from bdata_metrics import metrics, METRICS_HOST
+from bdata_partition import maintain_trade_partitions
 
+# percentage bands around mid price, same as the an array of make_stat_step_book
+BOOK_BANDS = ['0.01', '0.02', '0.03', '0.05', '0.08', '0.1', '0.2', '0.3', '0.5', '0.8',
+              '1', '2', '3', '5', '8', '10', '20', '30', '50', '80', '100']
 
-def make_stat_step_book() -> None:
+
+class BookEngine(Enum):
+    SQL = "sql"
+    NUMPY = "numpy"
+
+
+# book_snap_stat layout of books from partial depth streams, book_depth() data of the streamed levels only
+STREAM_LAYOUT = "stream"
+
+
+class TradeEngine(Enum):
+    LOOP = "loop"
+    SET = "set"
+
+
+def market_filter(markets: Optional[List[int]]) -> str:
+    """SQL condition on exchange_market_id for statements that take no parameters, empty for all markets."""
+    if markets is None:
+        return ''
+    return 'and exchange_market_id = any(array[{}]::integer[])'.format(','.join(str(int(i)) for i in markets))
+
+
+def make_stat_step_book(markets: Optional[List[int]] = None) -> None:
     with engine.connect().execution_options(autocommit=True) as connection:
         connection.execute(text("""
             do $$
@@ -21,7 +57,7 @@ def make_stat_step_book() -> None:
                     bsida bigint[];
                     cur record;
                 begin
-                    for cur in select * from book_snap where not stat limit 100 for update skip locked loop
+                    for cur in select * from book_snap where not stat {} limit 100 for update skip locked loop
                         bsid := cur.book_snap_id;
                         if bsid is null
                         then
@@ -31,6 +67,15 @@ def make_stat_step_book() -> None:
                         bsida = array_append(bsida, bsid);
                         raise notice 'bsid=%', bsid;
                         delete from book_snap_stat where book_snap_id = bsid;
+                        -- array stored snapshots are expanded into level rows for bookSnapStat
+                        insert into book_snap_bid(book_snap_id, price, amount)
+                        select bsid, u.price, u.amount
+                        from book_snap_side s, unnest(s.price, s.amount) u(price, amount)
+                        where s.book_snap_id = bsid and s.side = 'B';
+                        insert into book_snap_ask(book_snap_id, price, amount)
+                        select bsid, u.price, u.amount
+                        from book_snap_side s, unnest(s.price, s.amount) u(price, amount)
+                        where s.book_snap_id = bsid and s.side = 'A';
                         foreach n in array an
                             loop
                                 code := 'r' || n::text;
@@ -43,12 +88,80 @@ def make_stat_step_book() -> None:
                     end loop;
                     delete from book_snap_bid where book_snap_id = any(bsida);
                     delete from book_snap_ask where book_snap_id = any(bsida);
+                    delete from book_snap_side where book_snap_id = any(bsida);
                 end
             $$;
-                        """))
+                        """.format(market_filter(markets))))
+
+
+def book_depth(bid_p: np.ndarray, bid_a: np.ndarray, ask_p: np.ndarray, ask_a: np.ndarray) -> dict:
+    """Cumulative depth for every BOOK_BANDS band, bids sorted by price desc and asks asc."""
+    if len(bid_p) == 0 or len(ask_p) == 0:
+        return {}
+    mid = (bid_p[0] + ask_p[0]) / 2
+    bands = np.array([float(b) for b in BOOK_BANDS]) / 100
+    cum = {}
+    for (side, p, a, idx) in [('bid', bid_p, bid_a, np.searchsorted(-bid_p, -mid * (1 - bands), side='right')),
+                              ('ask', ask_p, ask_a, np.searchsorted(ask_p, mid * (1 + bands), side='right'))]:
+        amount = np.concatenate(([0.0], np.cumsum(a)))[idx]
+        total = np.concatenate(([0.0], np.cumsum(p * a)))[idx]
+        cum[side] = (idx, amount, total)
+    return {'r' + b: {'mid': float(mid),
+                      'bid': {'n': int(cum['bid'][0][i]), 'amount': float(cum['bid'][1][i]),
+                              'total': float(cum['bid'][2][i])},
+                      'ask': {'n': int(cum['ask'][0][i]), 'amount': float(cum['ask'][1][i]),
+                              'total': float(cum['ask'][2][i])}}
+            for (i, b) in enumerate(BOOK_BANDS)}
+
+
+def book_stat(bids: list, asks: list) -> dict:
+    bids = np.array(bids, dtype=np.float64).reshape(-1, 2)
+    asks = np.array(asks, dtype=np.float64).reshape(-1, 2)
+    bids = bids[np.argsort(-bids[:, 0], kind='stable')]
+    asks = asks[np.argsort(asks[:, 0], kind='stable')]
+    return book_depth(bids[:, 0], bids[:, 1], asks[:, 0], asks[:, 1])
+
+
+def book_levels(connection, view: str, ids: list, desc: bool) -> dict:
+    rows = connection.execute(text(
+        'select book_snap_id, price::float8, amount::float8 from {} where book_snap_id = any(:ids) '
+        'order by book_snap_id, price {}'.format(view, 'desc' if desc else 'asc')), {'ids': ids}).fetchall()
+    if not rows:
+        return {}
+    arr = np.array(rows, dtype=np.float64)
+    bsid = arr[:, 0].astype(np.int64)
+    starts = np.flatnonzero(np.r_[True, bsid[1:] != bsid[:-1]])
+    ends = np.r_[starts[1:], len(bsid)]
+    return {int(bsid[i]): (arr[i:j, 1], arr[i:j, 2]) for (i, j) in zip(starts, ends)}
+
+
+def make_stat_step_book_np(limit: int = 100, markets: Optional[List[int]] = None) -> int:
+    with engine.begin() as connection:
+        ids = [r[0] for r in connection.execute(text(
+            'select book_snap_id from book_snap where not stat {} limit :limit for update skip locked'.format(
+                market_filter(markets))), {'limit': limit})]
+        if not ids:
+            return 0
+        bids = book_levels(connection, 'vbook_snap_bid', ids, True)
+        asks = book_levels(connection, 'vbook_snap_ask', ids, False)
+        empty = (np.empty(0), np.empty(0))
+        stats = []
+        for bsid in ids:
+            (bid_p, bid_a) = bids.get(bsid, empty)
+            (ask_p, ask_a) = asks.get(bsid, empty)
+            for (code, data) in book_depth(bid_p, bid_a, ask_p, ask_a).items():
+                stats.append({'bsid': bsid, 'code': code, 'data': json.dumps(data), 'layout': BookEngine.NUMPY.value})
+        connection.execute(text('delete from book_snap_stat where book_snap_id = any(:ids)'), {'ids': ids})
+        if stats:
+            connection.execute(text('insert into book_snap_stat(book_snap_id, code, data, layout) '
+                                    'values (:bsid, :code, cast(:data as jsonb), :layout)'), stats)
+        connection.execute(text('update book_snap set stat = true where book_snap_id = any(:ids)'), {'ids': ids})
+        for table in ['book_snap_bid', 'book_snap_ask', 'book_snap_side']:
+            connection.execute(text('delete from {} where book_snap_id = any(:ids)'.format(table)), {'ids': ids})
+        return len(ids)
 
 
-def make_stat_step_trade(m: int, n: int):
+def make_stat_step_trade(ids: List[int]):
     with engine.connect().execution_options(autocommit=True) as connection:
         connection.execute(text(
             f"""
@@ -75,7 +188,7 @@ $$
             select exchange_market_id, gst, gen
             from s1
             where gst <= gen
-                and exchange_market_id % {m} = {n}
+                {market_filter(ids)}
             order by exchange_market_id
             loop
                 --raise notice '% % %', cur.exchange_market_id, cur.gst, cur.gen;
@@ -115,30 +228,433 @@ $$;
             """))
 
 
-BOOK_WORKERS = 2
-TRADE_WORKERS = 2
+# minutes built per market and pass by make_stat_step_trade_set
+TRADE1M_MAX_MINUTES = 60 * 24 * 7
+
+
+def make_stat_step_trade_set(ids: List[int]):
+    """Set based trade1m builder: one grouped scan per market, empty minutes forward filled with the last close.
+
+    s/sb/ss are base amounts, z/zb/zs quote amounts (price * amount), n/nb/ns trade counts and d is sb - ss.
+    """
+    with engine.connect().execution_options(autocommit=True) as connection:
+        connection.execute(text(
+            f"""
+with s1 as (select exchange_market_id,
+                   coalesce((select max(dt) from trade1m where exchange_market_id = em.exchange_market_id) +
+                            interval '1m'
+                       , date_trunc('minute', (select min(to_timestamp(ts::numeric / 1000::numeric))
+                                               from trade
+                                               where exchange_market_id = em.exchange_market_id))
+                       ) gst,
+                   date_trunc('minute', to_timestamp(trade_ts::numeric / 1000::numeric)) -
+                   interval '1m' gen
+            from exchange_market em
+            where em.trade_ts is not null and not coalesce(em.disabled, false)
+                and em.exchange_market_id = any(:ids)),
+     s2 as (select exchange_market_id, gst,
+                   least(gen, gst + interval '{TRADE1M_MAX_MINUTES - 1} minutes') gen,
+                   (select c
+                    from trade1m
+                    where exchange_market_id = s1.exchange_market_id and dt = s1.gst - interval '1m') last_c
+            from s1
+            where gst <= gen),
+     agg as (select s2.exchange_market_id,
+                    date_trunc('minute', to_timestamp(t.ts::numeric / 1000::numeric))::timestamp dt,
+                    (array_agg(t.price order by t.ts, t.trade_id))[1] o,
+                    max(t.price) h,
+                    min(t.price) l,
+                    (array_agg(t.price order by t.ts desc, t.trade_id desc))[1] c,
+                    sum(t.amount) s,
+                    coalesce(sum(t.amount) filter (where t.side = 'B'), 0) sb,
+                    coalesce(sum(t.amount) filter (where t.side = 'S'), 0) ss,
+                    sum(t.price * t.amount) z,
+                    coalesce(sum(t.price * t.amount) filter (where t.side = 'B'), 0) zb,
+                    coalesce(sum(t.price * t.amount) filter (where t.side = 'S'), 0) zs,
+                    count(*) n,
+                    count(*) filter (where t.side = 'B') nb,
+                    count(*) filter (where t.side = 'S') ns
+             from s2
+                 join trade t on t.exchange_market_id = s2.exchange_market_id
+                     and t.ts >= (extract(epoch from s2.gst) * 1000)::bigint
+                     and t.ts < (extract(epoch from s2.gen + interval '1m') * 1000)::bigint
+             group by 1, 2),
+     grid as (select s2.exchange_market_id, s2.last_c, g.dt::timestamp dt
+              from s2,
+                  generate_series(s2.gst, s2.gen, interval '1m') g(dt)),
+     joined as (select grid.exchange_market_id, grid.dt, grid.last_c,
+                       agg.o, agg.h, agg.l, agg.c, agg.s, agg.sb, agg.ss, agg.z, agg.zb, agg.zs,
+                       agg.n, agg.nb, agg.ns,
+                       count(agg.c) over (partition by grid.exchange_market_id order by grid.dt) grp
+                from grid
+                    left join agg on agg.exchange_market_id = grid.exchange_market_id and agg.dt = grid.dt),
+     filled as (select *,
+                       coalesce(first_value(c) over (partition by exchange_market_id, grp order by dt), last_c) fc
+                from joined)
+insert into trade1m(dt, exchange_market_id, o, h, l, c, s, sb, ss, z, zb, zs, n, nb, ns, d)
+select dt, exchange_market_id,
+       coalesce(o, fc), coalesce(h, fc), coalesce(l, fc), coalesce(c, fc),
+       coalesce(s, 0), coalesce(sb, 0), coalesce(ss, 0),
+       coalesce(z, 0), coalesce(zb, 0), coalesce(zs, 0),
+       coalesce(n, 0), coalesce(nb, 0), coalesce(ns, 0),
+       coalesce(sb - ss, 0)
+from filled
+on conflict (exchange_market_id, dt) do update
+    set o = excluded.o, h = excluded.h, l = excluded.l, c = excluded.c,
+        s = excluded.s, sb = excluded.sb, ss = excluded.ss,
+        z = excluded.z, zb = excluded.zb, zs = excluded.zs,
+        n = excluded.n, nb = excluded.nb, ns = excluded.ns,
+        d = excluded.d;
+            """), {'ids': ids})
+
+
+# resolution, source table, source step, bucket expression; each level rolls up the previous one
+ROLLUPS = [
+    ('5m', 'trade1m', '1m', "date_trunc('hour', {0}) + floor(extract(minute from {0}) / 5) * interval '5m'"),
+    ('15m', 'trade5m', '5m', "date_trunc('hour', {0}) + floor(extract(minute from {0}) / 15) * interval '15m'"),
+    ('1h', 'trade15m', '15m', "date_trunc('hour', {0})"),
+    ('1d', 'trade1h', '1h', "date_trunc('day', {0})"),
+]
+ROLLUP_MAX_BARS = 10000
+
+
+def make_stat_step_rollup(ids: List[int], renew: Optional[Callable[[], None]] = None):
+    """Rolls complete buckets of each source table into trade5m/15m/1h/1d, tracked by trade_rollup_mark. renew is
+    called after each resolution."""
+    for (resolution, source, step, bucket) in ROLLUPS:
+        with engine.connect().execution_options(autocommit=True) as connection:
+            connection.execute(text(
+                f"""
+with w as (select exchange_market_id, st, least(en, st + {ROLLUP_MAX_BARS} * interval '{resolution}') en
+           from (select em.exchange_market_id,
+                        coalesce(rm.dt, (select {bucket.format('min(dt)')}
+                                         from {source}
+                                         where exchange_market_id = em.exchange_market_id)) st,
+                        (select {bucket.format("max(dt) + interval '" + step + "'")}
+                         from {source}
+                         where exchange_market_id = em.exchange_market_id) en
+                 from exchange_market em
+                     left join trade_rollup_mark rm
+                         on rm.exchange_market_id = em.exchange_market_id and rm.resolution = '{resolution}'
+                 where em.exchange_market_id = any(:ids)
+                     and em.trade_ts is not null and not coalesce(em.disabled, false)) w0
+           where st < en),
+     agg as (select t.exchange_market_id,
+                    {bucket.format('t.dt')} dt,
+                    (array_agg(t.o order by t.dt))[1] o,
+                    max(t.h) h,
+                    min(t.l) l,
+                    (array_agg(t.c order by t.dt desc))[1] c,
+                    sum(t.s) s, sum(t.sb) sb, sum(t.ss) ss,
+                    sum(t.z) z, sum(t.zb) zb, sum(t.zs) zs,
+                    sum(t.n) n, sum(t.nb) nb, sum(t.ns) ns,
+                    sum(t.d) d
+             from w
+                 join {source} t on t.exchange_market_id = w.exchange_market_id and t.dt >= w.st and t.dt < w.en
+             group by 1, 2),
+     ins as (insert into trade{resolution}(exchange_market_id, dt, o, h, l, c, s, sb, ss, z, zb, zs, n, nb, ns, d)
+             select * from agg
+             on conflict (exchange_market_id, dt) do update
+                 set o = excluded.o, h = excluded.h, l = excluded.l, c = excluded.c,
+                     s = excluded.s, sb = excluded.sb, ss = excluded.ss,
+                     z = excluded.z, zb = excluded.zb, zs = excluded.zs,
+                     n = excluded.n, nb = excluded.nb, ns = excluded.ns,
+                     d = excluded.d)
+insert into trade_rollup_mark(exchange_market_id, resolution, dt)
+select exchange_market_id, '{resolution}', en
+from w
+on conflict (exchange_market_id, resolution) do update set dt = excluded.dt;
+                """), {'ids': ids})
+        if renew:
+            renew()
+
+
+# stat worker threads per process, any number of processes may run against one database
+WORKERS = 4
+# seconds a worker holds a leased trade job, renewed after each step; after that any worker may take the job over
+LEASE_SECONDS = 300
+# seconds a failed trade job is held back, doubled per consecutive failure up to FAIL_BACKOFF_MAX
+FAIL_BACKOFF = 15
+FAIL_BACKOFF_MAX = 900
+# seconds between fallback sweeps over all markets, notified markets are processed as they come in
+SWEEP_INTERVAL = 60
+# seconds without notifications before the listening connection is checked
+LISTEN_TIMEOUT = 60
+LISTEN_RETRY = 5
+PARTITION_INTERVAL = 3600
+# advisory lock held by the one process maintaining trade partitions
+PARTITION_LOCK = 0x62646174
+
+# markets are all markets when null
+ENQUEUE_SQL = text("""
+insert into stat_job(exchange_market_id, attempts)
+select exchange_market_id, 0
+from exchange_market
+where trade_ts is not null
+    and (cast(:markets as integer[]) is null or exchange_market_id = any(:markets))
+on conflict do nothing
+""")
+
+# a market is due once its trades reached a minute after the job mark, jobs nobody held before expired and backed
+# off ones, then the oldest mark first; failed jobs wait for their lease_until, expired leases of dead workers are
+# taken over
+LEASE_SQL = text("""
+update stat_job j
+set lease_until = now() + :lease * interval '1 second', owner = :owner, attempts = j.attempts + 1
+from (select s.exchange_market_id, em.trade_ts
+      from stat_job s
+          join exchange_market em on em.exchange_market_id = s.exchange_market_id
+      where em.trade_ts / 60000 > coalesce(s.mark, -60000) / 60000 and not coalesce(em.disabled, false)
+          and (s.lease_until is null or s.lease_until < now())
+          and (cast(:markets as integer[]) is null or s.exchange_market_id = any(:markets))
+      order by s.lease_until nulls first, s.mark nulls first
+      limit 1
+      for update of s skip locked) c
+where j.exchange_market_id = c.exchange_market_id
+returning j.exchange_market_id, c.trade_ts, j.attempts
+""")
+
+# true when a pass left no complete minute before mark unbuilt, trade1m passes are capped per market
+CAUGHT_UP_SQL = text("""
+select coalesce(coalesce((select max(dt) + interval '1m' from trade1m where exchange_market_id = :id),
+                         (select date_trunc('minute', min(to_timestamp(ts::numeric / 1000::numeric)))
+                          from trade
+                          where exchange_market_id = :id))
+                    > date_trunc('minute', to_timestamp(cast(:mark as numeric) / 1000::numeric)) - interval '1m', true)
+""")
+
+# heartbeat of a leased job, no row when the lease expired and was taken over
+RENEW_SQL = text("""
+update stat_job
+set lease_until = now() + :lease * interval '1 second'
+where exchange_market_id = :id and owner = :owner
+""")
+
+# owner fences out a worker whose lease expired and was taken over
+COMPLETE_SQL = text("""
+update stat_job
+set mark = case when :done then :mark else mark end, lease_until = null, owner = null, attempts = 0, error = null
+where exchange_market_id = :id and owner = :owner
+""")
+
+FAIL_SQL = text("""
+update stat_job
+set lease_until = now() + least(:max, :base * power(2, attempts - 1)) * interval '1 second', owner = null,
+    error = :error
+where exchange_market_id = :id and owner = :owner
+""")
+
+BACKLOG_SQL = text("""
+select count(*) filter (where em.trade_ts / 60000 > coalesce(j.mark, -60000) / 60000),
+       count(*) filter (where j.owner is not null and j.lease_until >= now()),
+       count(*) filter (where j.owner is not null and j.lease_until < now()),
+       count(*) filter (where j.owner is null and j.lease_until > now()),
+       (select count(*) from book_snap where not stat)
+from stat_job j
+    join exchange_market em on em.exchange_market_id = j.exchange_market_id
+where not coalesce(em.disabled, false)
+""")
+
+
+class StatQueue:
+    """Markets notified by the collectors until a worker takes them. A sweep hands every worker one pass over
+    all markets."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.books = set()
+        self.trades = set()
+        self.sweeps = 0
+
+    def put(self, channel: str, market: int):
+        with self.cond:
+            (self.books if channel == BOOK_CHANNEL else self.trades).add(market)
+            self.cond.notify()
+
+    def sweep(self):
+        with self.cond:
+            self.sweeps += 1
+            self.cond.notify_all()
+
+    def take(self, sweeps: int) -> Tuple[int, Optional[set], Optional[set]]:
+        """Waits for notified markets or a sweep after sweeps, returns (sweeps, books, trades), None markets for a
+        sweep."""
+        with self.cond:
+            self.cond.wait_for(lambda: self.books or self.trades or self.sweeps != sweeps)
+            if self.sweeps != sweeps:
+                return self.sweeps, None, None
+            (books, trades) = (self.books, self.trades)
+            (self.books, self.trades) = (set(), set())
+            return sweeps, books, trades
+
+
+def listen(queue: StatQueue):
+    """Feeds queue from the collectors' notifications. Notifications sent while not listening are lost, so every
+    (re)connect asks for a sweep."""
+    while True:
+        try:
+            connection = engine.raw_connection()
+            try:
+                pg = connection.connection
+                pg.autocommit = True
+                with pg.cursor() as cursor:
+                    cursor.execute('listen {}; listen {}'.format(BOOK_CHANNEL, TRADE_CHANNEL))
+                logging.info('stat listening on {} {}'.format(BOOK_CHANNEL, TRADE_CHANNEL))
+                queue.sweep()
+                while True:
+                    # drained before waiting, execute() of listen and of the keepalive also collects notifications
+                    while pg.notifies:
+                        n = pg.notifies.pop(0)
+                        metrics.inc('stat_notifies', labels=())
+                        queue.put(n.channel, int(n.payload))
+                    if select.select([pg], [], [], LISTEN_TIMEOUT) == ([], [], []):
+                        with pg.cursor() as cursor:
+                            cursor.execute('select 1')
+                    else:
+                        pg.poll()
+            finally:
+                connection.close()
+        except Exception as e:
+            logging.error('stat listen {} {}'.format(type(e).__name__, e))
+            time.sleep(LISTEN_RETRY)
+
+
+def books_pending(markets: Optional[List[int]]) -> bool:
+    with engine.connect() as connection:
+        return connection.execute(text(
+            'select exists(select 1 from book_snap where not stat {} limit 1 for update skip locked)'.format(
+                market_filter(markets)))).scalar()
+
+
+def make_books(book_engine: BookEngine, markets: Optional[List[int]] = None):
+    """Builds the stats of book snaps of markets, all markets when None, until none is left unlocked."""
+    while True:
+        if book_engine == BookEngine.NUMPY:
+            if make_stat_step_book_np(markets=markets) == 0:
+                return
+        else:
+            make_stat_step_book(markets)
+            if not books_pending(markets):
+                return
+
+
+class LeaseLost(Exception):
+    pass
+
+
+def renew_lease(emid: int, owner: str):
+    with engine.connect().execution_options(autocommit=True) as connection:
+        if connection.execute(RENEW_SQL, {'id': emid, 'owner': owner, 'lease': LEASE_SECONDS}).rowcount == 0:
+            raise LeaseLost('stat trade job {} lease taken over'.format(emid))
+
+
+def make_trade_job(owner: str, trade_engine: TradeEngine, markets: Optional[List[int]] = None) -> bool:
+    """Leases a due market of markets, all markets when None, and builds its trade1m bars and rollups renewing the
+    lease after each step, False when no market is due."""
+    with engine.connect().execution_options(autocommit=True) as connection:
+        if markets is not None:
+            connection.execute(ENQUEUE_SQL, {'markets': markets})
+        job = connection.execute(LEASE_SQL, {'lease': LEASE_SECONDS, 'owner': owner, 'markets': markets}).fetchone()
+    if job is None:
+        return False
+    (emid, mark, attempts) = job
+    renew = partial(renew_lease, emid, owner)
+    try:
+        with metrics.timer('stat_trade_job', ()):
+            (make_stat_step_trade_set if trade_engine == TradeEngine.SET else make_stat_step_trade)([emid])
+            renew()
+            make_stat_step_rollup([emid], renew)
+        with engine.connect().execution_options(autocommit=True) as connection:
+            done = connection.execute(CAUGHT_UP_SQL, {'id': emid, 'mark': mark}).scalar()
+            connection.execute(COMPLETE_SQL, {'id': emid, 'mark': mark, 'done': done, 'owner': owner})
+    except LeaseLost as e:
+        # the new holder redoes the work, the steps are idempotent
+        logging.warning(str(e))
+    except Exception as e:
+        logging.error('stat trade job {} attempt {} {} {}'.format(emid, attempts, type(e).__name__, e))
+        metrics.inc('stat_job_errors', labels=())
+        with engine.connect().execution_options(autocommit=True) as connection:
+            connection.execute(FAIL_SQL, {'id': emid, 'owner': owner, 'base': FAIL_BACKOFF, 'max': FAIL_BACKOFF_MAX,
+                                          'error': '{} {}'.format(type(e).__name__, e)[:1000]})
+    return True
+
+
+def stat_worker(owner: str, queue: StatQueue, book_engine: BookEngine, trade_engine: TradeEngine):
+    """Processes notified markets as they come in and all markets on each sweep."""
+    sweeps = 0
+    while True:
+        (sweeps, books, trades) = queue.take(sweeps)
+        try:
+            if books is None or books:
+                make_books(book_engine, None if books is None else list(books))
+            if trades is None or trades:
+                # a market leased elsewhere when notified is picked up again by its holder
+                while make_trade_job(owner, trade_engine, None if trades is None else list(trades)):
+                    pass
+        except Exception as e:
+            logging.error('{} {} {}'.format(owner, type(e).__name__, e))
+
+
+def stat_backlog() -> dict:
+    with engine.connect() as connection:
+        row = connection.execute(BACKLOG_SQL).fetchone()
+    return dict(zip(['due', 'leased', 'expired', 'failed', 'books'], row))
+
+
+def make_partitions(trade_retention: int):
+    with engine.connect() as connection:
+        if not connection.execute(text('select pg_try_advisory_lock(:k)'), {'k': PARTITION_LOCK}).scalar():
+            return
+        try:
+            maintain_trade_partitions(trade_retention)
+        finally:
+            connection.execute(text('select pg_advisory_unlock(:k)'), {'k': PARTITION_LOCK})
 
 
-def make_stats():
-    next_ts = datetime.now() - timedelta(seconds=1)
+def make_stats(book_engine: BookEngine = BookEngine.SQL, trade_engine: TradeEngine = TradeEngine.LOOP,
+               trade_retention: int = 0, workers: int = WORKERS, sweep_interval: int = SWEEP_INTERVAL):
+    prefix = '{}:{}'.format(socket.gethostname(), os.getpid())
+    queue = StatQueue()
+    for i in range(workers):
+        threading.Thread(target=stat_worker, args=('{}:{}'.format(prefix, i), queue, book_engine, trade_engine),
+                         name='stat-{}'.format(i), daemon=True).start()
+    threading.Thread(target=listen, args=(queue,), name='stat-listen', daemon=True).start()
+    logging.info('stat workers {} started {}'.format(prefix, workers))
+    next_partition_ts = datetime.now() - timedelta(seconds=1)
     while True:
-        if datetime.now() >= next_ts:
-            next_ts = datetime.now() + timedelta(seconds=15)
+        if datetime.now() >= next_partition_ts:
+            next_partition_ts = datetime.now() + timedelta(seconds=PARTITION_INTERVAL)
             try:
-                logging.info('start stats calculation')
-                with ThreadPoolExecutor(max_workers=BOOK_WORKERS + TRADE_WORKERS) as ex:
-                    for i in range(0, BOOK_WORKERS):
-                        ex.submit(make_stat_step_book)
-                    for i in range(0, TRADE_WORKERS):
-                        ex.submit(make_stat_step_trade, TRADE_WORKERS, i)
-                logging.info('stop stats calculation')
+                make_partitions(trade_retention)
             except Exception as e:
                 logging.error(str(e))
-                pass
-        time.sleep(1)
+        try:
+            with engine.connect().execution_options(autocommit=True) as connection:
+                connection.execute(ENQUEUE_SQL, {'markets': None})
+            backlog = stat_backlog()
+            for (k, v) in backlog.items():
+                metrics.set('stat_backlog_' + k, v)
+            logging.info('stat backlog {}'.format(' '.join('{}={}'.format(k, v) for (k, v) in backlog.items())))
+        except Exception as e:
+            logging.error(str(e))
+        queue.sweep()
+        time.sleep(sweep_interval)
 
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format='%(asctime)s.%(msecs)03d %(levelname)-8s %(message)s',
                         datefmt='%Y-%m-%d %H:%M:%S')
-    make_stats()
+    parser = ArgumentParser()
+    parser.add_argument('--book_engine', type=BookEngine, choices=list(BookEngine), default=BookEngine.SQL)
+    parser.add_argument('--trade_engine', type=TradeEngine, choices=list(TradeEngine), default=TradeEngine.LOOP)
+    # months of trade partitions kept attached, 0 - keep all
+    parser.add_argument('--trade_retention', default=0, type=int)
+    parser.add_argument('--workers', default=WORKERS, type=int)
+    # seconds between fallback sweeps over all markets
+    parser.add_argument('--sweep_interval', default=SWEEP_INTERVAL, type=int)
+    parser.add_argument('--metrics_port', default=0, type=int)
+    parser.add_argument('--metrics_host', default=METRICS_HOST)
+    args = parser.parse_args()
+    if args.metrics_port:
+        metrics.serve(args.metrics_port, args.metrics_host)
+    make_stats(args.book_engine, args.trade_engine, args.trade_retention, args.workers, args.sweep_interval)
@@ -0,0 +1,284 @@
+import asyncio
+import datetime
+import json
+import logging
+import threading
+from abc import ABC, abstractmethod
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+import aiohttp
+import ccxt
+
+from bdata_db import Session
+from bdata_metrics import metrics
+from bdata_snap import ensure_exchange_market, store_trades, store_stream_book, snap_trades
+
+# seconds between trade flushes
+FLUSH_INTERVAL = 1.0
+# seconds between stored books of a market, the latest streamed book is kept in between
+STREAM_BOOK_INTERVAL = 10
+RECONNECT_MAX = 60
+
+
+class Feed(ABC):
+    """WebSocket subscription to the trades and books of some markets of one exchange.
+
+    events() yields ('trade', symbol, [ccxt trade]) and ('book', symbol, {timestamp, bids, asks}) and raises when the
+    connection drops. Streamed books are partial depth, far shallower than the REST books.
+    """
+    # markets per connection
+    MAX_MARKETS = 100
+
+    def __init__(self, exchange: ccxt.Exchange, markets: List[dict]):
+        self.exchange = exchange
+        self.markets = markets
+
+    @abstractmethod
+    def events(self) -> AsyncIterator[Tuple[str, str, object]]:
+        pass
+
+
+class BinanceFeed(Feed):
+    """aggTrade and partial depth streams; aggTrade ids are the REST fetch_trades ids, so the fetch cursor stays
+    valid across stream and REST."""
+    URL = 'wss://stream.binance.com:9443/stream?streams='
+
+    async def events(self) -> AsyncIterator[Tuple[str, str, object]]:
+        symbols = {m['id'].lower(): m['symbol'] for m in self.markets}
+        streams = '/'.join(s + suffix for s in symbols for suffix in ('@aggTrade', '@depth20@100ms'))
+        async with aiohttp.ClientSession() as session:
+            async with session.ws_connect(self.URL + streams, heartbeat=30) as ws:
+                async for msg in ws:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        break
+                    m = json.loads(msg.data)
+                    (stream, data) = (m['stream'], m['data'])
+                    symbol = symbols[stream.split('@')[0]]
+                    if stream.endswith('@aggTrade'):
+                        yield 'trade', symbol, [{'id': str(data['a']), 'timestamp': data['T'],
+                                                 'side': 'sell' if data['m'] else 'buy',
+                                                 'price': float(data['p']), 'amount': float(data['q'])}]
+                    else:
+                        # partial depth events carry no time
+                        yield 'book', symbol, {'timestamp': self.exchange.milliseconds(), 'bids': data['bids'],
+                                               'asks': data['asks']}
+        raise ConnectionError('{} stream closed'.format(self.exchange.id))
+
+
+class ReplayFeed(Feed):
+    """Replays events recorded with --stream_record, paced by their recorded time, then reports a dropped feed."""
+    MAX_MARKETS = 100000
+
+    def __init__(self, exchange: ccxt.Exchange, markets: List[dict], path: str, speed: float = 1.0):
+        super().__init__(exchange, markets)
+        self.path = path
+        self.speed = speed
+
+    async def events(self) -> AsyncIterator[Tuple[str, str, object]]:
+        symbols = {m['symbol'] for m in self.markets}
+        prior = None
+        with open(self.path) as f:
+            for line in f:
+                e = json.loads(line)
+                if e['exchange'] != self.exchange.id or e['symbol'] not in symbols or e['kind'] not in FEED_KINDS:
+                    continue
+                if prior is not None and e['ts'] > prior:
+                    await asyncio.sleep((e['ts'] - prior) / 1000 / self.speed)
+                prior = e['ts']
+                yield e['kind'], e['symbol'], e['data']
+        raise ConnectionError('{} replay of {} ended'.format(self.exchange.id, self.path))
+
+
+FEED_KINDS = ('trade', 'book')
+
+FEEDS = {
+    'binance': BinanceFeed,
+}
+
+
+class StreamCollector:
+    """Captures trades and books from exchange feeds on its own event loop thread.
+
+    Trades are buffered and flushed every FLUSH_INTERVAL seconds through store_trades, so the fetch cursor follows
+    the stream. A market counts as live once its feed is connected and the REST catch-up from its cursor is done;
+    the REST snap loop fetches the trades of markets that are not live and the books of all markets. The latest
+    streamed book of a market is stored every STREAM_BOOK_INTERVAL seconds with the stream layout, next to the REST
+    books of the interval.
+    """
+
+    def __init__(self, args: Namespace, exchanges: List[ccxt.Exchange], market_filter: Callable[[dict], bool]):
+        self.args = args
+        self.exchanges = exchanges
+        self.market_filter = market_filter
+        self.db_pool = ThreadPoolExecutor(max_workers=2)
+        self.live_keys = set()
+        self.catching_up = set()
+        self.markets: Dict[Tuple[str, str], dict] = {}
+        self.trades: Dict[Tuple[str, str], list] = {}
+        self.books: Dict[Tuple[str, str], dict] = {}
+        # key -> timestamp of the last stored streamed book
+        self.book_ts: Dict[Tuple[str, str], int] = {}
+        self.record = open(args.stream_record, 'a') if args.stream_record else None
+
+    def live(self, exchange_id: str, symbol: str) -> bool:
+        return (exchange_id, symbol) in self.live_keys
+
+    def start(self):
+        threading.Thread(target=asyncio.run, args=(self.run(),), name='stream', daemon=True).start()
+
+    def feed(self, exchange: ccxt.Exchange, markets: List[dict]) -> Optional[Feed]:
+        if self.args.stream_replay:
+            return ReplayFeed(exchange, markets, self.args.stream_replay)
+        cls = FEEDS.get(exchange.id)
+        return cls(exchange, markets) if cls else None
+
+    async def run(self):
+        tasks = [self.flush_loop()]
+        for exchange in self.exchanges:
+            markets = [m for m in list(exchange.markets.values()) if self.market_filter(m)]
+            self.markets.update(((exchange.id, m['symbol']), m) for m in markets)
+            feed = self.feed(exchange, markets)
+            if feed is None:
+                logging.info('{} no stream, REST only'.format(exchange.id))
+                continue
+            for i in range(0, len(markets), feed.MAX_MARKETS):
+                tasks.append(self.supervise(exchange, markets[i:i + feed.MAX_MARKETS]))
+        await asyncio.gather(*tasks)
+
+    async def supervise(self, exchange: ccxt.Exchange, markets: List[dict]):
+        keys = [(exchange.id, m['symbol']) for m in markets]
+        delay = 1
+        while True:
+            connected = False
+            try:
+                async for (kind, symbol, data) in self.feed(exchange, markets).events():
+                    if not connected:
+                        connected = True
+                        delay = 1
+                        logging.info('{} stream up markets={}'.format(exchange.id, len(markets)))
+                        self.catching_up.update(keys)
+                        asyncio.ensure_future(self.catch_up(exchange, markets))
+                    self.on_event(exchange, kind, symbol, data)
+            except Exception as e:
+                logging.error('{} stream down {} {}'.format(exchange.id, type(e).__name__, e))
+            # store what the feed delivered for live markets, then REST snaps take over until the feed is back
+            trades = {k: self.trades.pop(k) for k in keys if k in self.trades and k in self.live_keys}
+            self.live_keys.difference_update(keys)
+            self.catching_up.difference_update(keys)
+            for key in keys:
+                self.trades.pop(key, None)
+                self.books.pop(key, None)
+            if trades:
+                try:
+                    await asyncio.get_running_loop().run_in_executor(self.db_pool, self.flush, trades, {})
+                except Exception as e:
+                    logging.error('stream flush {} {}'.format(type(e).__name__, e))
+            await asyncio.sleep(delay)
+            delay = min(RECONNECT_MAX, delay * 2)
+
+    def on_event(self, exchange: ccxt.Exchange, kind: str, symbol: str, data):
+        key = (exchange.id, symbol)
+        # trades of markets that are neither live nor catching up are fetched by REST
+        if kind == 'trade' and (key in self.live_keys or key in self.catching_up):
+            self.trades.setdefault(key, []).extend(data)
+        elif kind == 'book':
+            self.books[key] = data
+        if self.record:
+            self.record.write(json.dumps({'ts': exchange.milliseconds(), 'exchange': exchange.id, 'symbol': symbol,
+                                          'kind': kind, 'data': data}) + '\n')
+
+    async def catch_up(self, exchange: ccxt.Exchange, markets: List[dict]):
+        """Fetches trades between each market's cursor and the stream by REST, then marks the market live."""
+        loop = asyncio.get_running_loop()
+        keys = [(exchange.id, m['symbol']) for m in markets]
+        for (key, m) in zip(keys, markets):
+            try:
+                await loop.run_in_executor(self.db_pool, self.catch_up_market, exchange, m)
+                if key in self.catching_up:
+                    self.live_keys.add(key)
+            except Exception as e:
+                logging.error('{}::{} stream catch up {} {}'.format(exchange.id, m['symbol'], type(e).__name__, e))
+                self.trades.pop(key, None)
+            self.catching_up.discard(key)
+
+    def catch_up_market(self, exchange: ccxt.Exchange, market: dict):
+        session = Session()
+        try:
+            with metrics.labels(exchange.id, market['symbol']):
+                snap_trades(session, datetime.datetime.now(), exchange, market['base'], market['quote'])
+        finally:
+            session.close()
+
+    async def flush_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            # markets still catching up keep their buffer, their trades must land after the REST catch-up
+            trades = {k: self.trades.pop(k) for k in list(self.trades) if k in self.live_keys}
+            books = self.due_books()
+            if trades or books:
+                try:
+                    failed = await loop.run_in_executor(self.db_pool, self.flush, trades, books)
+                except Exception as e:
+                    logging.error('stream flush {} {}'.format(type(e).__name__, e))
+                    failed = list(trades)
+                for key in failed:
+                    self.resync(key)
+            if self.record:
+                self.record.flush()
+
+    def due_books(self) -> Dict[Tuple[str, str], dict]:
+        books = {}
+        for key in list(self.books):
+            last = self.book_ts.get(key)
+            if last is None or self.books[key]['timestamp'] - last >= STREAM_BOOK_INTERVAL * 1000:
+                books[key] = self.books.pop(key)
+                self.book_ts[key] = books[key]['timestamp']
+        return books
+
+    def resync(self, key: Tuple[str, str]):
+        """Takes a market whose trades could not be stored off live and catches it up again from its stored cursor,
+        REST snaps cover it meanwhile."""
+        if key not in self.live_keys:
+            return
+        self.live_keys.discard(key)
+        self.trades.pop(key, None)
+        self.catching_up.add(key)
+        exchange = next(e for e in self.exchanges if e.id == key[0])
+        asyncio.ensure_future(self.catch_up(exchange, [self.markets[key]]))
+
+    def flush(self, trades: Dict[Tuple[str, str], list], books: Dict[Tuple[str, str], dict]) -> list:
+        """Stores each market on its own, returns the keys whose trades failed. A failed book is dropped, the next
+        one replaces it."""
+        exchanges = {e.id: e for e in self.exchanges}
+        failed = []
+        session = Session()
+        try:
+            for (key, t) in trades.items():
+                (exchange, m) = (exchanges[key[0]], self.markets[key])
+                try:
+                    (e, em, bt, qt) = ensure_exchange_market(session, exchange, m['base'], m['quote'])
+                    if not em.disabled:
+                        with metrics.labels(*key):
+                            metrics.inc('stream_trades', len(t))
+                            store_trades(session, exchange, em, m['symbol'], t)
+                except Exception as e:
+                    session.rollback()
+                    failed.append(key)
+                    logging.error('{}::{} stream trades {} {}'.format(key[0], key[1], type(e).__name__, e))
+            for (key, b) in books.items():
+                (exchange, m) = (exchanges[key[0]], self.markets[key])
+                try:
+                    (e, em, bt, qt) = ensure_exchange_market(session, exchange, m['base'], m['quote'])
+                    if not em.disabled:
+                        with metrics.labels(*key):
+                            metrics.inc('stream_books')
+                            store_stream_book(session, em, datetime.datetime.fromtimestamp(b['timestamp'] / 1000), b)
+                except Exception as e:
+                    session.rollback()
+                    logging.error('{}::{} stream book {} {}'.format(key[0], key[1], type(e).__name__, e))
+        finally:
+            session.close()
+        return failed